@@ -1,147 +1,773 @@
 import anthropic
-from typing import List, Optional, Dict, Any
+import asyncio
+import httpx
+import inspect
+import json
+import re
+import threading
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Callable, Generator, Iterator, List, Optional, Dict, Any, Sequence, Tuple
+
+# Shared HTTP connection pools, so TLS handshakes and keep-alive connections
+# are reused across AIGenerator instances. Created lazily on first use.
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=40)
+_HTTP_TIMEOUT = 30.0
+_HTTP_CLIENT: Optional[httpx.Client] = None
+_ASYNC_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+_http_client_lock = threading.Lock()
+
+# Yielded by stream_response when the text streamed since the last marker was
+# a preamble to a tool call (e.g. "Let me search."), which the consumer drops
+STREAM_DISCARD = object()
+
+# Shared, never-mutated request fragments reused on every call
+_TOOL_CHOICE_AUTO = {"type": "auto"}
+_EPHEMERAL_CACHE = {"type": "ephemeral"}
+_HISTORY_PREFIX = "Previous conversation:\n"
+
+
+def _get_http_client() -> httpx.Client:
+    """Return the process-wide sync HTTP client used by the Anthropic SDK"""
+    global _HTTP_CLIENT
+    with _http_client_lock:
+        if _HTTP_CLIENT is None:
+            _HTTP_CLIENT = anthropic.DefaultHttpxClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+        return _HTTP_CLIENT
+
+
+def _get_async_http_client() -> httpx.AsyncClient:
+    """Return the process-wide async HTTP client used by the Anthropic SDK"""
+    global _ASYNC_HTTP_CLIENT
+    with _http_client_lock:
+        if _ASYNC_HTTP_CLIENT is None:
+            _ASYNC_HTTP_CLIENT = anthropic.DefaultAsyncHttpxClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+        return _ASYNC_HTTP_CLIENT
+
+
+@lru_cache(maxsize=4)
+def _get_client(api_key: str) -> anthropic.Anthropic:
+    """
+    Return the shared Anthropic client for an API key.
+    Call _get_client.cache_clear() after rotating API keys.
+    """
+    return anthropic.Anthropic(api_key=api_key, http_client=_get_http_client())
+
+
+@lru_cache(maxsize=4)
+def _get_async_client(api_key: str) -> anthropic.AsyncAnthropic:
+    """
+    Return the shared AsyncAnthropic client for an API key.
+    Call _get_async_client.cache_clear() after rotating API keys.
+    """
+    return anthropic.AsyncAnthropic(api_key=api_key, http_client=_get_async_http_client())
+
 
 class AIGenerator:
-    """Handles interactions with Anthropic's Claude API for generating responses"""
+    """
+    Handles interactions with Anthropic's Claude API for generating responses.
+
+    A tool_manager only needs execute_tool(name, **input). These optional
+    methods are used when present:
+    - execute_tools(calls): dispatch a round's calls as one batch, which
+      ToolManager runs concurrently; without it calls run one at a time
+    - aexecute_tool(name, **input): async dispatch on the async path
+    - is_stateful(name): if missing, every tool counts as stateful, so
+      identical concurrent requests are not coalesced
+    - get_last_sources() / restore_sources(sources): if missing, cached and
+      coalesced answers are served without sources
+    """
 
     MAX_TOOL_ROUNDS = 2
+    TEMPERATURE = 0
+    MAX_TOKENS = 800
+    # Follow-up rounds mostly synthesize tool results into a short answer
+    SYNTHESIS_MAX_TOKENS = 400
+    RESPONSE_CACHE_SIZE = 512
+    SEMANTIC_CACHE_SIZE = 1024
+    SEMANTIC_CACHE_THRESHOLD = 0.93
+    TOOLS_CACHE_SIZE = 32
+
+    FALLBACK_RESPONSE = "I'm sorry, I wasn't able to generate a response. Please try again."
+
+    # Static system prompt, split so tool guidance is only sent when tools are offered
+    SYSTEM_PROMPT_CORE = """You are an AI assistant for course materials and educational content.
+- Answer general knowledge questions from your own knowledge.
+- Give only the direct answer: no reasoning process, search explanations, question-type analysis, or "based on the search results".
+- Be brief, educational and clear; include examples only when they aid understanding.
+"""
 
-    # Static system prompt to avoid rebuilding on each call
-    SYSTEM_PROMPT = """ You are an AI assistant specialized in course materials and educational content with access to a comprehensive search tool for course information.
-
-Search Tool Usage:
-- Use the search tool **only** for questions about specific course content or detailed educational materials
-- You may use up to 2 tool calls sequentially when needed (e.g., get a course outline first, then search for specific content)
-- Prefer a single tool call when possible; use a second only when the first result is insufficient
-- Synthesize search results into accurate, fact-based responses
-- If search yields no results, state this clearly without offering alternatives
-
-Course Outline Tool Usage:
-- Use the `get_course_outline` tool for questions about course structure, lesson lists, or outlines (e.g., "What lessons are in...", "Show me the outline of...", "What does the course cover?")
-- When presenting outline results, include the course title, course link, and each lesson's number and title
-
-Response Protocol:
-- **General knowledge questions**: Answer using existing knowledge without searching
-- **Course-specific questions**: Search first, then answer
-- **No meta-commentary**:
- - Provide direct answers only — no reasoning process, search explanations, or question-type analysis
- - Do not mention "based on the search results"
-
-
-All responses must be:
-1. **Brief, Concise and focused** - Get to the point quickly
-2. **Educational** - Maintain instructional value
-3. **Clear** - Use accessible language
-4. **Example-supported** - Include relevant examples when they aid understanding
-Provide only the direct answer to what was asked.
+    SYSTEM_PROMPT_TOOL_HINT = """Tools:
+- Use search_course_content only for questions about specific course content: search first, then answer.
+- Use get_course_outline for course structure, lesson lists or outlines; include the course title, course link, and each lesson's number and title.
+- Prefer one tool call; make a second (e.g. outline, then search) only if the first result is insufficient.
+- Synthesize results into accurate, fact-based answers; if a search finds nothing, say so without offering alternatives.
 """
+
+    # Prebuilt cacheable system blocks for the static prompt
+    CORE_BLOCK = {"type": "text", "text": SYSTEM_PROMPT_CORE, "cache_control": _EPHEMERAL_CACHE}
+    TOOL_HINT_BLOCK = {"type": "text", "text": SYSTEM_PROMPT_TOOL_HINT, "cache_control": _EPHEMERAL_CACHE}
     
-    def __init__(self, api_key: str, model: str):
-        self.client = anthropic.Anthropic(api_key=api_key)
+    def __init__(self, api_key: str, model: str,
+                 embedder: Optional[Callable[[List[str]], Sequence[Sequence[float]]]] = None,
+                 tool_selector: Optional[Callable[[str, List], List]] = None,
+                 per_call_timeout_s: float = 20.0,
+                 tool_timeout_s: float = 5.0):
+        self.client = _get_client(api_key)
+        self.aclient = _get_async_client(api_key)
         self.model = model
-        
-        # Pre-build base API parameters
-        self.base_params = {
-            "model": self.model,
-            "temperature": 0,
-            "max_tokens": 800
-        }
+
+        # Wall-clock budgets for the async path: a Claude call that overruns is
+        # raised to the caller, a tool call that overruns becomes an error result
+        self.per_call_timeout_s = per_call_timeout_s
+        self.tool_timeout_s = tool_timeout_s
+
+        # Optional hook that picks the subset of tools offered for a query, e.g. an
+        # embedding router. By default every tool is offered: a query can need
+        # both the outline and a content search, and keywords can't tell when.
+        self.tool_selector = tool_selector
+
+        # Cache-marked copies of tool selections, keyed by the identity of the
+        # definitions: ids -> (original definitions, marked list)
+        self._tools_cache: Dict[tuple, tuple] = {}
+
+        # Exact-match LRU cache: key -> (response text, sources)
+        self._response_cache: OrderedDict = OrderedDict()
+        self._response_cache_lock = threading.Lock()
+
+        # Semantic cache (enabled when an embedder is given): a FIFO ring of
+        # unit-normalized embeddings with one entry per row. Rows are grouped by
+        # a hash of (history, tool names); only rows in the request's group match.
+        self.embedder = embedder
+        self._semantic_embeddings: Optional[np.ndarray] = None
+        self._semantic_groups: Optional[np.ndarray] = None
+        self._semantic_entries: List[tuple] = []
+        self._semantic_next = 0
+
+        # Requests currently being generated, so identical concurrent requests
+        # wait for the first one instead of calling the API again.
+        # Sync path: key -> (Event, [(text, sources, error)]); async path: key -> Task
+        self._inflight: Dict[tuple, tuple] = {}
+        self._inflight_lock = threading.Lock()
+        self._ainflight: Dict[tuple, asyncio.Task] = {}
     
     def generate_response(self, query: str,
                          conversation_history: Optional[str] = None,
                          tools: Optional[List] = None,
-                         tool_manager=None) -> str:
+                         tool_manager=None,
+                         use_cache: bool = True,
+                         semantic_query: Optional[str] = None) -> str:
         """
         Generate AI response with optional tool usage and conversation context.
         Supports up to MAX_TOOL_ROUNDS sequential tool calls per query.
+        Identical (query, history, tools) requests, and near-duplicates when an
+        embedder is configured, are answered from cache unless use_cache is False.
+        Near-duplicates are matched on semantic_query (default: query), e.g. the
+        user's question without the prompt template, and need the same history.
+        Identical requests already in flight share one API call.
         """
+        if not use_cache:
+            return self._generate(query, conversation_history, tools, tool_manager, None)
 
-        # Build system content
-        system_content = (
-            f"{self.SYSTEM_PROMPT}\n\nPrevious conversation:\n{conversation_history}"
-            if conversation_history
-            else self.SYSTEM_PROMPT
+        cached, cache_state = self._cache_lookup(
+            query, conversation_history, tools, tool_manager, semantic_query
         )
+        if cached is not None:
+            return cached
 
-        # Prepare initial API call parameters
-        api_params = {
-            **self.base_params,
-            "system": system_content
-        }
-
-        messages = [{"role": "user", "content": query}]
+        generate = partial(self._generate, query, conversation_history, tools, tool_manager, cache_state)
+        if not self._can_coalesce(tools, tool_manager):
+            return generate()
+        return self._coalesce(cache_state[0], tool_manager, generate)
 
-        # Add tools if available
-        if tools:
-            api_params["tools"] = tools
-            api_params["tool_choice"] = {"type": "auto"}
+    def _generate(self, query: str, conversation_history: Optional[str],
+                  tools: Optional[List], tool_manager,
+                  cache_state: Optional[tuple]) -> str:
+        """Run the uncached request and tool-use loop for generate_response"""
+        api_params, system_content, tools = self._build_initial_params(
+            query, conversation_history, tools
+        )
+        messages = api_params["messages"]
 
         # Get initial response
-        api_params["messages"] = messages
         response = self.client.messages.create(**api_params)
 
         # Tool-use loop
+        tool_error = False
         for round in range(self.MAX_TOOL_ROUNDS):
-            if response.stop_reason != "tool_use" or not tool_manager:
+            tool_blocks = self._pending_tool_calls(response) if tool_manager else []
+            if not tool_blocks:
                 break
 
             # Execute tools and append results to messages
-            tool_error = not self._execute_tool_round(response, messages, tool_manager)
-
-            # Build follow-up params; include tools only if more rounds remain and no error
-            follow_up_params = {
-                **self.base_params,
-                "messages": messages,
-                "system": system_content
-            }
-            if tools and not tool_error and round < self.MAX_TOOL_ROUNDS - 1:
-                follow_up_params["tools"] = tools
-                follow_up_params["tool_choice"] = {"type": "auto"}
+            tool_error = not self._execute_tool_round(response, tool_blocks, messages, tool_manager)
 
+            follow_up_params = self._build_follow_up_params(
+                messages, system_content, tools, tool_error, round
+            )
             response = self.client.messages.create(**follow_up_params)
 
             if tool_error:
                 break
 
-        # Extract text from final response
+        return self._finish_response(response, tool_error, cache_state, tool_manager)
+
+    async def agenerate_response(self, query: str,
+                                 conversation_history: Optional[str] = None,
+                                 tools: Optional[List] = None,
+                                 tool_manager=None,
+                                 use_cache: bool = True,
+                                 semantic_query: Optional[str] = None) -> str:
+        """
+        Async variant of generate_response using the AsyncAnthropic client,
+        so concurrent requests can share one event loop.
+        """
+        if not use_cache:
+            return await self._agenerate(query, conversation_history, tools, tool_manager, None)
+
+        # Embedding the query is CPU work, so keep it off the event loop
+        cached, cache_state = await asyncio.to_thread(
+            self._cache_lookup, query, conversation_history, tools, tool_manager, semantic_query
+        )
+        if cached is not None:
+            return cached
+
+        generate = partial(self._agenerate, query, conversation_history, tools, tool_manager, cache_state)
+        if not self._can_coalesce(tools, tool_manager):
+            return await generate()
+        return await self._acoalesce(cache_state[0], tool_manager, generate)
+
+    async def _agenerate(self, query: str, conversation_history: Optional[str],
+                         tools: Optional[List], tool_manager,
+                         cache_state: Optional[tuple]) -> str:
+        """Run the uncached request and tool-use loop for agenerate_response"""
+        api_params, system_content, tools = self._build_initial_params(
+            query, conversation_history, tools
+        )
+        messages = api_params["messages"]
+
+        # Get initial response
+        response = await self._acreate(api_params)
+
+        # Tool-use loop
+        tool_error = False
+        for round in range(self.MAX_TOOL_ROUNDS):
+            tool_blocks = self._pending_tool_calls(response) if tool_manager else []
+            if not tool_blocks:
+                break
+
+            # Execute tools and append results to messages
+            tool_error = not await self._aexecute_tool_round(response, tool_blocks, messages, tool_manager)
+
+            follow_up_params = self._build_follow_up_params(
+                messages, system_content, tools, tool_error, round
+            )
+            response = await self._acreate(follow_up_params)
+
+            if tool_error:
+                break
+
+        return self._finish_response(response, tool_error, cache_state, tool_manager)
+
+    def stream_response(self, query: str,
+                        conversation_history: Optional[str] = None,
+                        tools: Optional[List] = None,
+                        tool_manager=None,
+                        use_cache: bool = True,
+                        semantic_query: Optional[str] = None) -> Iterator[Any]:
+        """
+        Streaming variant of generate_response that yields text as it arrives.
+
+        Every API call is streamed, since any round may turn out to be the final
+        answer. When a round ends in a tool call, STREAM_DISCARD is yielded if
+        it streamed text, so the consumer drops that preamble and keeps only the
+        answer generate_response would return. Tool-use rounds are driven from
+        the completed message exactly as in generate_response. Cache hits are
+        yielded as a single chunk.
+        """
+        cache_state = None
+        if use_cache:
+            cached, cache_state = self._cache_lookup(
+                query, conversation_history, tools, tool_manager, semantic_query
+            )
+            if cached is not None:
+                yield cached
+                return
+
+        api_params, system_content, tools = self._build_initial_params(
+            query, conversation_history, tools
+        )
+        messages = api_params["messages"]
+
+        # Stream initial response
+        response = yield from self._stream_message(api_params)
+
+        # Tool-use loop
+        tool_error = False
+        for round in range(self.MAX_TOOL_ROUNDS):
+            tool_blocks = self._pending_tool_calls(response) if tool_manager else []
+            if not tool_blocks:
+                break
+
+            # Text streamed before the tool call is not part of the answer
+            if any(block.type == "text" for block in response.content):
+                yield STREAM_DISCARD
+
+            # Execute tools and append results to messages
+            tool_error = not self._execute_tool_round(response, tool_blocks, messages, tool_manager)
+
+            follow_up_params = self._build_follow_up_params(
+                messages, system_content, tools, tool_error, round
+            )
+            response = yield from self._stream_message(follow_up_params)
+
+            if tool_error:
+                break
+
+        text = self._finish_response(response, tool_error, cache_state, tool_manager)
+        if text == self.FALLBACK_RESPONSE:
+            yield text
+
+    async def _acreate(self, api_params: Dict[str, Any]):
+        """Await one API call, raising TimeoutError after per_call_timeout_s"""
+        return await asyncio.wait_for(
+            self.aclient.messages.create(**api_params), timeout=self.per_call_timeout_s
+        )
+
+    def _stream_message(self, api_params: Dict[str, Any]) -> Generator[str, None, Any]:
+        """Yield text deltas of one streamed API call, then return the final message"""
+        with self.client.messages.stream(**api_params) as stream:
+            yield from stream.text_stream
+            return stream.get_final_message()
+
+    @staticmethod
+    def _can_coalesce(tools: Optional[List], tool_manager) -> bool:
+        """Identical requests may only share a result if no offered tool is stateful"""
+        if not tools or not tool_manager:
+            return True
+        is_stateful = getattr(tool_manager, "is_stateful", None)
+        if is_stateful is None:
+            return False
+        return not any(is_stateful(tool["name"]) for tool in tools)
+
+    @staticmethod
+    def _capture_sources(tool_manager) -> list:
+        """Copy the tool manager's last sources, or [] if it does not track any"""
+        get_last_sources = getattr(tool_manager, "get_last_sources", None)
+        return list(get_last_sources()) if get_last_sources else []
+
+    @staticmethod
+    def _restore_sources(tool_manager, sources: list):
+        """Hand cached sources back to the tool manager, if it supports that"""
+        restore_sources = getattr(tool_manager, "restore_sources", None)
+        if restore_sources:
+            restore_sources(sources)
+
+    def _coalesce(self, cache_key: tuple, tool_manager, generate: Callable[[], str]) -> str:
+        """Run generate() once per key across threads; concurrent callers share its outcome"""
+        with self._inflight_lock:
+            slot = self._inflight.get(cache_key)
+            is_leader = slot is None
+            if is_leader:
+                slot = self._inflight[cache_key] = (threading.Event(), [])
+        done, outcome = slot
+
+        if not is_leader:
+            done.wait()
+            text, sources, error = outcome[0]
+            if error is not None:
+                raise error
+            self._restore_sources(tool_manager, sources)
+            return text
+
+        try:
+            text = generate()
+            sources = self._capture_sources(tool_manager)
+            outcome.append((text, sources, None))
+            return text
+        except Exception as e:
+            outcome.append((None, None, e))
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[cache_key]
+            done.set()
+
+    async def _acoalesce(self, cache_key: tuple, tool_manager, generate) -> str:
+        """
+        Await generate() once per key on the event loop; concurrent callers share its outcome.
+        generate() runs as its own task and every caller awaits it through a shield,
+        so a cancelled caller only stops its own wait, not the shared generation.
+        """
+        # No await between the lookup and the insert, so no lock is needed
+        task = self._ainflight.get(cache_key)
+        is_leader = task is None
+        if is_leader:
+            async def run():
+                text = await generate()
+                return text, self._capture_sources(tool_manager)
+
+            task = self._ainflight[cache_key] = asyncio.ensure_future(run())
+            task.add_done_callback(partial(self._ainflight_done, cache_key))
+
+        text, sources = await asyncio.shield(task)
+        if not is_leader:
+            self._restore_sources(tool_manager, sources)
+        return text
+
+    def _ainflight_done(self, cache_key: tuple, task: asyncio.Task):
+        """Drop a finished shared generation from _ainflight"""
+        if self._ainflight.get(cache_key) is task:
+            del self._ainflight[cache_key]
+        # Mark the exception retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def _build_initial_params(self, query: str,
+                              conversation_history: Optional[str],
+                              tools: Optional[List]):
+        """
+        Build the initial API call parameters.
+
+        Returns (api_params, system_content, tools) where tools carries the
+        cache_control marker and is reused for follow-up rounds.
+        """
+        if tools and self.tool_selector:
+            tools = self.tool_selector(query, tools)
+        if tools:
+            # Mark the last tool definition so the tool schemas are cached too
+            tools = self._mark_tools_cacheable(tools)
+
+        system_content = self._build_system(conversation_history, bool(tools))
+
+        api_params = self._build_params(
+            [{"role": "user", "content": query}], system_content, tools
+        )
+        return api_params, system_content, tools
+
+    def _mark_tools_cacheable(self, tools: List) -> List:
+        """
+        Return tools with cache_control on the last definition, without mutating them.
+        Memoized by definition identity, so callers that share definition dicts
+        (e.g. ToolManager.get_tool_definitions) reuse one marked list per selection.
+        """
+        key = tuple(map(id, tools))
+        entry = self._tools_cache.get(key)
+        if entry is None:
+            if len(self._tools_cache) >= self.TOOLS_CACHE_SIZE:
+                self._tools_cache.clear()
+            marked = [*tools[:-1], {**tools[-1], "cache_control": _EPHEMERAL_CACHE}]
+            # Keep the originals alive so their ids cannot be reused while cached
+            entry = self._tools_cache[key] = (tuple(tools), marked)
+        return entry[1]
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _build_system(conversation_history: Optional[str], with_tools: bool) -> List[Dict[str, Any]]:
+        """
+        Build the system blocks; the static prompt is marked cacheable, history is not.
+        The tool hint is only included when tools are offered.
+        Memoized per history string, since history only changes between turns.
+        The returned list is shared and must not be mutated.
+        """
+        system_content = [AIGenerator.CORE_BLOCK]
+        if with_tools:
+            system_content.append(AIGenerator.TOOL_HINT_BLOCK)
+        if conversation_history:
+            system_content.append(
+                {"type": "text", "text": "".join((_HISTORY_PREFIX, conversation_history))}
+            )
+        return system_content
+
+    def _build_follow_up_params(self, messages: List, system_content: List,
+                                tools: Optional[List], tool_error: bool,
+                                round: int) -> Dict[str, Any]:
+        """Build follow-up params; include tools only if more rounds remain and no error"""
+        include_tools = not tool_error and round < self.MAX_TOOL_ROUNDS - 1
+        return self._build_params(
+            messages, system_content, tools if include_tools else None,
+            max_tokens=self.SYNTHESIS_MAX_TOKENS
+        )
+
+    def _build_params(self, messages: List, system_content: List,
+                      tools: Optional[List] = None,
+                      max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """Build API call parameters in one dict literal; tools are added only if given"""
+        api_params = {
+            "model": self.model,
+            "temperature": self.TEMPERATURE,
+            "max_tokens": max_tokens or self.MAX_TOKENS,
+            "system": system_content,
+            "messages": messages
+        }
+        if tools:
+            api_params["tools"] = tools
+            api_params["tool_choice"] = _TOOL_CHOICE_AUTO
+        return api_params
+
+    def _finish_response(self, response, tool_error: bool, cache_state: Optional[tuple],
+                         tool_manager) -> str:
+        """Extract the final text and cache it if it is a clean, complete answer"""
+        text = self._extract_text(response)
+        if (cache_state is not None and response.stop_reason == "end_turn"
+                and not tool_error and text != self.FALLBACK_RESPONSE):
+            cache_key, embedding = cache_state
+            sources = self._capture_sources(tool_manager)
+            self._cache_put(cache_key, text, sources)
+            if embedding is not None:
+                self._semantic_cache_put(embedding, cache_key, text, sources)
+        return text
+
+    def _cache_lookup(self, query: str, conversation_history: Optional[str],
+                      tools: Optional[List], tool_manager,
+                      semantic_query: Optional[str] = None) -> Tuple[Optional[str], tuple]:
+        """
+        Look a request up in the exact-match cache, then the semantic cache.
+
+        Returns (cached text or None, cache_state) where cache_state is the
+        (cache_key, embedding) pair used to store the response on a miss.
+        Sources of a cache hit are restored on the tool manager.
+        """
+        cache_key = self._cache_key(query, conversation_history, tools)
+        embedding = None
+
+        entry = self._cache_get(cache_key)
+        if entry is None and self.embedder is not None:
+            # Only the question is embedded: history would dominate the embedding,
+            # or fill the embedder's input window so different questions embed alike
+            embedding = self._embed(semantic_query or query)
+            entry = self._semantic_cache_get(embedding, cache_key)
+
+        if entry is None:
+            return None, (cache_key, embedding)
+
+        text, sources = entry
+        self._restore_sources(tool_manager, sources)
+        return text, (cache_key, embedding)
+
+    @staticmethod
+    def _cache_key(query: str, conversation_history: Optional[str],
+                   tools: Optional[List]) -> tuple:
+        """Build the response cache key from the normalized query, history and tool names"""
+        return (
+            query.strip().lower(),
+            conversation_history or "",
+            tuple(sorted(tool["name"] for tool in tools or []))
+        )
+
+    def _cache_get(self, cache_key: tuple) -> Optional[tuple]:
+        """Return the cached (text, sources) entry for an exact key, if any"""
+        with self._response_cache_lock:
+            entry = self._response_cache.get(cache_key)
+            if entry is not None:
+                self._response_cache.move_to_end(cache_key)
+            return entry
+
+    def _cache_put(self, cache_key: tuple, text: str, sources: list):
+        """Store a response and the sources it was built from, evicting the LRU entry"""
+        with self._response_cache_lock:
+            self._response_cache[cache_key] = (text, sources)
+            self._response_cache.move_to_end(cache_key)
+            if len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+
+    def _embed(self, text: str) -> np.ndarray:
+        """Embed text with the configured embedder and normalize to unit length"""
+        vector = np.asarray(self.embedder([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _semantic_cache_get(self, embedding: np.ndarray, cache_key: tuple) -> Optional[tuple]:
+        """
+        Return the (text, sources) of the most similar cached request if its cosine
+        similarity clears SEMANTIC_CACHE_THRESHOLD. Candidates must have the same
+        history and tools, and mention the same numbers (e.g. lesson 1 vs lesson 2).
+        """
+        group = hash(cache_key[1:])
+        with self._response_cache_lock:
+            count = len(self._semantic_entries)
+            if not count:
+                return None
+            # Rows are unit vectors, so one matmul gives every cosine similarity
+            scores = self._semantic_embeddings[:count] @ embedding
+            scores[self._semantic_groups[:count] != group] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < self.SEMANTIC_CACHE_THRESHOLD:
+                return None
+            numbers, context, text, sources = self._semantic_entries[best]
+
+        # The group hash can collide, so compare history and tools exactly too
+        if context != cache_key[1:] or numbers != re.findall(r"\d+", cache_key[0]):
+            return None
+        return text, sources
+
+    def _semantic_cache_put(self, embedding: np.ndarray, cache_key: tuple, text: str, sources: list):
+        """Add an entry to the semantic cache, overwriting the oldest once full"""
+        entry = (re.findall(r"\d+", cache_key[0]), cache_key[1:], text, sources)
+        with self._response_cache_lock:
+            if self._semantic_embeddings is None:
+                self._semantic_embeddings = np.zeros(
+                    (self.SEMANTIC_CACHE_SIZE, embedding.shape[0]), dtype=np.float32
+                )
+                self._semantic_groups = np.zeros(self.SEMANTIC_CACHE_SIZE, dtype=np.int64)
+            slot = self._semantic_next
+            self._semantic_embeddings[slot] = embedding
+            self._semantic_groups[slot] = hash(cache_key[1:])
+            if slot < len(self._semantic_entries):
+                self._semantic_entries[slot] = entry
+            else:
+                self._semantic_entries.append(entry)
+            self._semantic_next = (slot + 1) % self.SEMANTIC_CACHE_SIZE
+
+    def _extract_text(self, response) -> str:
+        """Extract text from the final response"""
         for block in response.content:
             if block.type == "text":
                 return block.text
 
-        return "I'm sorry, I wasn't able to generate a response. Please try again."
+        return self.FALLBACK_RESPONSE
+
+    @staticmethod
+    def _pending_tool_calls(response) -> List:
+        """
+        Return the tool_use blocks Claude is waiting on, in a single pass.
+        Empty unless stop_reason is tool_use, so callers can skip the follow-up call.
+        """
+        if response.stop_reason != "tool_use":
+            return []
+        return [block for block in response.content if block.type == "tool_use"]
+
+    @staticmethod
+    def _assistant_message(response) -> Dict[str, Any]:
+        """
+        Convert response content to plain dicts once, so later rounds re-send a
+        flat structure instead of SDK objects. Unknown block types pass through.
+        """
+        content = []
+        for block in response.content:
+            if block.type == "tool_use":
+                content.append({"type": "tool_use", "id": block.id, "name": block.name, "input": block.input})
+            elif block.type == "text":
+                content.append({"type": "text", "text": block.text})
+            else:
+                content.append(block)
+        return {"role": "assistant", "content": content}
 
-    def _execute_tool_round(self, response, messages: List, tool_manager) -> bool:
+    def _execute_tool_round(self, response, calls: List, messages: List, tool_manager) -> bool:
         """
-        Execute tool calls from a response and append results to messages.
+        Execute the tool_use blocks in calls and append results to messages.
+        Uses tool_manager.execute_tools to dispatch the round as one batch when
+        available (ToolManager runs independent calls concurrently); otherwise
+        calls run one at a time through execute_tool. Duplicate calls in the
+        turn are executed once.
 
         Returns True on success, False on error.
         """
-        messages.append({"role": "assistant", "content": response.content})
+        messages.append(self._assistant_message(response))
+        unique, positions = self._dedupe_calls(calls)
+
+        if hasattr(tool_manager, "execute_tools"):
+            outcomes = tool_manager.execute_tools([(block.name, block.input) for block in unique])
+        else:
+            outcomes = [self._run_tool(tool_manager, block) for block in unique]
+
+        return self._append_tool_results(messages, calls, [outcomes[i] for i in positions])
+
+    async def _aexecute_tool_round(self, response, calls: List, messages: List, tool_manager) -> bool:
+        """
+        Async variant of _execute_tool_round. Uses tool_manager.aexecute_tool when
+        available, otherwise runs execute_tool in a worker thread so the event
+        loop is not blocked. Tool calls in the same turn are gathered concurrently,
+        each bounded by tool_timeout_s; duplicates are executed once.
 
+        Returns True on success, False on error.
+        """
+        messages.append(self._assistant_message(response))
+        unique, positions = self._dedupe_calls(calls)
+
+        aexecute_tool = getattr(tool_manager, "aexecute_tool", None)
+        if not inspect.iscoroutinefunction(aexecute_tool):
+            aexecute_tool = None
+
+        async def run(block):
+            if aexecute_tool:
+                call = aexecute_tool(block.name, **block.input)
+            else:
+                call = asyncio.to_thread(tool_manager.execute_tool, block.name, **block.input)
+            return await asyncio.wait_for(call, timeout=self.tool_timeout_s)
+
+        outcomes = await asyncio.gather(*(run(block) for block in unique), return_exceptions=True)
+
+        return self._append_tool_results(messages, calls, [outcomes[i] for i in positions])
+
+    @staticmethod
+    def _dedupe_calls(calls: List) -> Tuple[List, List[int]]:
+        """
+        Collapse tool_use blocks with the same name and input.
+
+        Returns (unique blocks, index into unique for each block in calls), so
+        every tool_use_id still gets its own tool_result.
+        """
+        unique: List = []
+        index_by_key: Dict[tuple, int] = {}
+        positions = []
+        for block in calls:
+            key = (block.name, json.dumps(block.input, sort_keys=True, default=str))
+            if key not in index_by_key:
+                index_by_key[key] = len(unique)
+                unique.append(block)
+            positions.append(index_by_key[key])
+        return unique, positions
+
+    @staticmethod
+    def _run_tool(tool_manager, content_block):
+        """Execute one tool call, returning the exception instead of raising it"""
+        try:
+            return tool_manager.execute_tool(content_block.name, **content_block.input)
+        except Exception as e:
+            return e
+
+    def _append_tool_results(self, messages: List, calls: List, outcomes: List) -> bool:
+        """
+        Append one tool_result per call, in call order, as a user message.
+
+        Returns True if every call succeeded, False if any raised.
+        """
         tool_results = []
-        for content_block in response.content:
-            if content_block.type == "tool_use":
-                try:
-                    tool_result = tool_manager.execute_tool(
-                        content_block.name,
-                        **content_block.input
-                    )
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": content_block.id,
-                        "content": tool_result
-                    })
-                except Exception as e:
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": content_block.id,
-                        "content": f"Error executing tool: {e}",
-                        "is_error": True
-                    })
-                    if tool_results:
-                        messages.append({"role": "user", "content": tool_results})
-                    return False
+        tool_error = False
+        for content_block, outcome in zip(calls, outcomes):
+            if isinstance(outcome, BaseException):
+                if not isinstance(outcome, Exception):
+                    raise outcome
+                tool_results.append(self._tool_error(content_block, outcome))
+                tool_error = True
+            else:
+                tool_results.append(self._tool_result(content_block, outcome))
 
         if tool_results:
             messages.append({"role": "user", "content": tool_results})
-        return True
\ No newline at end of file
+        return not tool_error
+
+    @staticmethod
+    def _tool_result(content_block, tool_result: str) -> Dict[str, Any]:
+        """Build a tool_result block for a successful tool call"""
+        return {
+            "type": "tool_result",
+            "tool_use_id": content_block.id,
+            "content": tool_result
+        }
+
+    @staticmethod
+    def _tool_error(content_block, error: Exception) -> Dict[str, Any]:
+        """Build an error tool_result block for a failed or timed-out tool call"""
+        if isinstance(error, TimeoutError):
+            content = "Tool timed out"
+        else:
+            content = f"Error executing tool: {error}"
+        return {
+            "type": "tool_result",
+            "tool_use_id": content_block.id,
+            "content": content,
+            "is_error": True
+        }
@@ -5,8 +5,10 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Any, Dict, List, Optional
+import json
 import os
 
 from config import config
@@ -63,7 +65,7 @@ async def query_documents(request: QueryRequest):
             session_id = rag_system.session_manager.create_session()
         
         # Process query using RAG system
-        answer, sources = rag_system.query(request.query, session_id)
+        answer, sources = await rag_system.aquery(request.query, session_id)
         
         return QueryResponse(
             answer=answer,
@@ -73,6 +75,29 @@ async def query_documents(request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/query/stream")
+async def stream_query_documents(request: QueryRequest):
+    """Process a query and stream the answer as newline-delimited JSON events (see RAGSystem.stream_query)"""
+    # Create session if not provided
+    session_id = request.session_id
+    if not session_id:
+        session_id = rag_system.session_manager.create_session()
+
+    def events():
+        # Errors after the response has started can only be reported in-band
+        try:
+            for event in rag_system.stream_query(request.query, session_id):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    # Starlette iterates sync generators in a threadpool, so the loop stays free
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"X-Session-ID": session_id}
+    )
+
 @app.delete("/api/sessions/{session_id}")
 async def delete_session(session_id: str):
     """Delete a conversation session"""
@@ -1,8 +1,8 @@
-from typing import List, Tuple, Optional, Dict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import os
 from document_processor import DocumentProcessor
 from vector_store import VectorStore
-from ai_generator import AIGenerator
+from ai_generator import AIGenerator, STREAM_DISCARD
 from session_manager import SessionManager
 from search_tools import ToolManager, CourseSearchTool, CourseOutlineTool
 from models import Course, Lesson, CourseChunk
@@ -16,7 +16,10 @@ class RAGSystem:
         # Initialize core components
         self.document_processor = DocumentProcessor(config.CHUNK_SIZE, config.CHUNK_OVERLAP)
         self.vector_store = VectorStore(config.CHROMA_PATH, config.EMBEDDING_MODEL, config.MAX_RESULTS)
-        self.ai_generator = AIGenerator(config.ANTHROPIC_API_KEY, config.ANTHROPIC_MODEL)
+        self.ai_generator = AIGenerator(
+            config.ANTHROPIC_API_KEY, config.ANTHROPIC_MODEL,
+            embedder=self.vector_store.embedding_function
+        )
         self.session_manager = SessionManager(config.MAX_HISTORY)
         
         # Initialize search tools
@@ -26,6 +29,13 @@ class RAGSystem:
         self.outline_tool = CourseOutlineTool(self.vector_store)
         self.tool_manager.register_tool(self.outline_tool)
 
+    def _create_tool_manager(self) -> ToolManager:
+        """Create a ToolManager with fresh tool instances (own source tracking)"""
+        tool_manager = ToolManager()
+        tool_manager.register_tool(CourseSearchTool(self.vector_store))
+        tool_manager.register_tool(CourseOutlineTool(self.vector_store))
+        return tool_manager
+
     def add_course_document(self, file_path: str) -> Tuple[Course, int]:
         """
         Add a single course document to the knowledge base.
@@ -112,27 +122,92 @@ class RAGSystem:
         Returns:
             Tuple of (response, sources list - empty for tool-based approach)
         """
-        # Create prompt for the AI with clear instructions
-        prompt = f"""Answer this question about course materials: {query}"""
-        
-        # Get conversation history if session exists
-        history = None
-        if session_id:
-            history = self.session_manager.get_conversation_history(session_id)
-        
+        prompt, history = self._prepare_query(query, session_id)
+
         # Generate response using AI with tools
         response = self.ai_generator.generate_response(
             query=prompt,
             conversation_history=history,
+            semantic_query=query,
             tools=self.tool_manager.get_tool_definitions(),
             tool_manager=self.tool_manager
         )
+
+        return self._finish_query(query, session_id, response, self.tool_manager)
+
+    async def aquery(self, query: str, session_id: Optional[str] = None) -> Tuple[str, List[str]]:
+        """
+        Async variant of query() for use from the event loop.
+
+        Each call gets its own ToolManager so that sources tracked by
+        concurrent requests do not overwrite each other.
+        """
+        prompt, history = self._prepare_query(query, session_id)
+        tool_manager = self._create_tool_manager()
+
+        # Generate response using AI with tools
+        response = await self.ai_generator.agenerate_response(
+            query=prompt,
+            conversation_history=history,
+            semantic_query=query,
+            # Same tool set as the shared manager, so reuse its definitions list
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=tool_manager
+        )
+
+        return self._finish_query(query, session_id, response, tool_manager)
+
+    def stream_query(self, query: str, session_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streaming variant of query().
+
+        Yields {"text": chunk} events as the answer is generated, followed by a
+        final {"sources": [...]} event. A {"discard": True} event means the text
+        events since the previous discard were a preamble to a tool call and
+        should be dropped. Like aquery(), each call gets its own ToolManager.
+        """
+        prompt, history = self._prepare_query(query, session_id)
+        tool_manager = self._create_tool_manager()
+
+        chunks = []
+        for chunk in self.ai_generator.stream_response(
+            query=prompt,
+            conversation_history=history,
+            semantic_query=query,
+            # Same tool set as the shared manager, so reuse its definitions list
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=tool_manager
+        ):
+            if chunk is STREAM_DISCARD:
+                chunks.clear()
+                yield {"discard": True}
+                continue
+            chunks.append(chunk)
+            yield {"text": chunk}
+
+        _, sources = self._finish_query(query, session_id, "".join(chunks), tool_manager)
+        yield {"sources": sources}
+
+    def _prepare_query(self, query: str, session_id: Optional[str]) -> Tuple[str, Optional[str]]:
+        """Build the prompt and fetch conversation history for a query"""
+        # Create prompt for the AI with clear instructions
+        prompt = f"""Answer this question about course materials: {query}"""
         
+        # Get conversation history if session exists
+        history = None
+        if session_id:
+            history = self.session_manager.get_conversation_history(session_id)
+
+        return prompt, history
+
+    def _finish_query(self, query: str, session_id: Optional[str], response: str,
+                      tool_manager: ToolManager) -> Tuple[str, List[str]]:
+        """Collect sources and record the exchange once a response is generated"""
         # Get sources from the search tool
-        sources = self.tool_manager.get_last_sources()
+        sources = tool_manager.get_last_sources()
 
         # Reset sources after retrieving them
-        self.tool_manager.reset_sources()
+        tool_manager.reset_sources()
         
         # Update conversation history
         if session_id:
@@ -1,10 +1,14 @@
-from typing import Dict, Any, Optional, Protocol
+from typing import Dict, Any, List, Optional, Protocol, Tuple
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from vector_store import VectorStore, SearchResults
 
 
 class Tool(ABC):
     """Abstract base class for all tools"""
+
+    # Tools with side effects set this so identical concurrent requests are not merged
+    stateful: bool = False
     
     @abstractmethod
     def get_tool_definition(self) -> Dict[str, Any]:
@@ -16,6 +20,13 @@ class Tool(ABC):
         """Execute the tool with given parameters"""
         pass
 
+    def execute_with_sources(self, **kwargs) -> Tuple[str, Optional[list]]:
+        """
+        Execute without recording last_sources, returning (result, sources).
+        sources is None if the call leaves last_sources unchanged.
+        """
+        return self.execute(**kwargs), None
+
 
 class CourseSearchTool(Tool):
     """Tool for searching course content with semantic course name matching"""
@@ -61,7 +72,16 @@ class CourseSearchTool(Tool):
         Returns:
             Formatted search results or error message
         """
-        
+        result, sources = self.execute_with_sources(
+            query=query, course_name=course_name, lesson_number=lesson_number
+        )
+        if sources is not None:
+            self.last_sources = sources
+        return result
+
+    def execute_with_sources(self, query: str, course_name: Optional[str] = None,
+                             lesson_number: Optional[int] = None) -> Tuple[str, Optional[list]]:
+        """Run the search, returning (result, sources); sources is None on error or no results"""
         # Use the vector store's unified search interface
         results = self.store.search(
             query=query,
@@ -71,7 +91,7 @@ class CourseSearchTool(Tool):
         
         # Handle errors
         if results.error:
-            return results.error
+            return results.error, None
         
         # Handle empty results
         if results.is_empty():
@@ -80,13 +100,18 @@ class CourseSearchTool(Tool):
                 filter_info += f" in course '{course_name}'"
             if lesson_number:
                 filter_info += f" in lesson {lesson_number}"
-            return f"No relevant content found{filter_info}."
+            return f"No relevant content found{filter_info}.", None
         
         # Format and return results
-        return self._format_results(results)
+        return self._format_with_sources(results)
     
     def _format_results(self, results: SearchResults) -> str:
         """Format search results with course and lesson context"""
+        formatted, self.last_sources = self._format_with_sources(results)
+        return formatted
+
+    def _format_with_sources(self, results: SearchResults) -> Tuple[str, list]:
+        """Format search results, returning (formatted text, sources for the UI)"""
         formatted = []
         sources = []  # Track sources for the UI
         
@@ -110,10 +135,7 @@ class CourseSearchTool(Tool):
             
             formatted.append(f"{header}\n{doc}")
         
-        # Store sources for retrieval
-        self.last_sources = sources
-        
-        return "\n\n".join(formatted)
+        return "\n\n".join(formatted), sources
 
 
 class CourseOutlineTool(Tool):
@@ -140,21 +162,28 @@ class CourseOutlineTool(Tool):
         }
 
     def execute(self, course_name: str) -> str:
+        result, sources = self.execute_with_sources(course_name=course_name)
+        if sources is not None:
+            self.last_sources = sources
+        return result
+
+    def execute_with_sources(self, course_name: str) -> Tuple[str, Optional[list]]:
+        """Build the course outline, returning (outline, sources); sources is None if not found"""
         import json
 
         # Resolve course name via fuzzy matching
         resolved_title = self.store._resolve_course_name(course_name)
         if not resolved_title:
-            return f"No course found matching '{course_name}'."
+            return f"No course found matching '{course_name}'.", None
 
         # Retrieve course metadata
         try:
             results = self.store.course_catalog.get(ids=[resolved_title])
         except Exception as e:
-            return f"Error retrieving course metadata: {e}"
+            return f"Error retrieving course metadata: {e}", None
 
         if not results or not results['metadatas'] or not results['metadatas'][0]:
-            return f"No metadata found for course '{resolved_title}'."
+            return f"No metadata found for course '{resolved_title}'.", None
 
         metadata = results['metadatas'][0]
         course_title = metadata.get('title', resolved_title)
@@ -164,8 +193,8 @@ class CourseOutlineTool(Tool):
 
         lessons = json.loads(lessons_json)
 
-        # Track source for the UI
-        self.last_sources = [{"label": course_title, "url": course_link}]
+        # Source for the UI
+        sources = [{"label": course_title, "url": course_link}]
 
         # Format the outline
         lines = [f"Course: {course_title}"]
@@ -184,7 +213,7 @@ class CourseOutlineTool(Tool):
                 entry += f" ({lesson_link})"
             lines.append(entry)
 
-        return "\n".join(lines)
+        return "\n".join(lines), sources
 
 
 class ToolManager:
@@ -192,6 +221,7 @@ class ToolManager:
     
     def __init__(self):
         self.tools = {}
+        self._tool_definitions = None
     
     def register_tool(self, tool: Tool):
         """Register any tool that implements the Tool interface"""
@@ -200,11 +230,17 @@ class ToolManager:
         if not tool_name:
             raise ValueError("Tool must have a 'name' in its definition")
         self.tools[tool_name] = tool
+        self._tool_definitions = None
 
     
     def get_tool_definitions(self) -> list:
-        """Get all tool definitions for Anthropic tool calling"""
-        return [tool.get_tool_definition() for tool in self.tools.values()]
+        """
+        Get all tool definitions for Anthropic tool calling.
+        Built once and shared until a tool is registered; must not be mutated.
+        """
+        if self._tool_definitions is None:
+            self._tool_definitions = [tool.get_tool_definition() for tool in self.tools.values()]
+        return self._tool_definitions
     
     def execute_tool(self, tool_name: str, **kwargs) -> str:
         """Execute a tool by name with given parameters"""
@@ -212,7 +248,40 @@ class ToolManager:
             return f"Tool '{tool_name}' not found"
         
         return self.tools[tool_name].execute(**kwargs)
+
+    def execute_tools(self, calls: List[Tuple[str, Dict[str, Any]]]) -> list:
+        """
+        Execute a batch of (tool_name, input) calls from one Claude turn.
+        Independent calls run concurrently in threads. Returns one outcome per
+        call, in order; a call that raised yields its exception instead.
+        Sources are recorded afterwards in call order, so they match a
+        sequential run whichever thread finishes last.
+        """
+        def run(call):
+            tool_name, tool_input = call
+            if tool_name not in self.tools:
+                return f"Tool '{tool_name}' not found", None
+            try:
+                return self.tools[tool_name].execute_with_sources(**tool_input)
+            except Exception as e:
+                return e, None
+
+        if len(calls) == 1:
+            outcomes = [run(calls[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+                outcomes = list(pool.map(run, calls))
+
+        for (tool_name, _), (_, sources) in zip(calls, outcomes):
+            if sources is not None:
+                self.tools[tool_name].last_sources = sources
+        return [result for result, _ in outcomes]
     
+    def is_stateful(self, tool_name: str) -> bool:
+        """Whether a registered tool has side effects (unknown tools count as stateful)"""
+        tool = self.tools.get(tool_name)
+        return tool is None or tool.stateful
+
     def get_last_sources(self) -> list:
         """Get sources from the last search operation"""
         # Check all tools for last_sources attribute
@@ -221,6 +290,14 @@ class ToolManager:
                 return tool.last_sources
         return []
 
+    def restore_sources(self, sources: list):
+        """Expose previously captured sources, e.g. for a response served from cache"""
+        self.reset_sources()
+        for tool in self.tools.values():
+            if hasattr(tool, 'last_sources'):
+                tool.last_sources = list(sources)
+                return
+
     def reset_sources(self):
         """Reset sources from all tools that track sources"""
         for tool in self.tools.values():
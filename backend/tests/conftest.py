@@ -1,53 +1,333 @@
+import copy
+import importlib.util
+import json
 import sys
 import os
 import pytest
-from unittest.mock import MagicMock
+from dataclasses import dataclass, field
+from typing import Optional
+from unittest.mock import MagicMock, NonCallableMagicMock, create_autospec
 
 # Add backend directory to path so we can import modules
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
+import anthropic
+import httpx
+import ai_generator
+from anthropic.resources import Messages
 from vector_store import VectorStore, SearchResults
 from models import Course, Lesson, CourseChunk
 
 
-@pytest.fixture
-def sample_search_results():
-    """SearchResults with 2 documents and realistic metadata"""
-    return SearchResults(
-        documents=[
-            "MCP stands for Model Context Protocol. It allows AI models to interact with external tools.",
-            "The MCP architecture uses a client-server pattern for tool communication."
-        ],
-        metadata=[
-            {"course_title": "Introduction to MCP", "lesson_number": 1, "chunk_index": 0},
-            {"course_title": "Introduction to MCP", "lesson_number": 2, "chunk_index": 3}
-        ],
-        distances=[0.25, 0.42]
+def pytest_addoption(parser):
+    parser.addoption(
+        "--run-live", action="store_true", default=False,
+        help="run live diagnostic tests that call the real Anthropic API"
+    )
+
+
+def pytest_ignore_collect(collection_path, config):
+    """Skip importing the live diagnostic modules unless --run-live is given"""
+    if collection_path.name.startswith("test_live_") and not config.getoption("--run-live"):
+        return True
+    return None
+
+
+@pytest.fixture(scope="session")
+def base_config():
+    """Config built once per session; copy it before overriding fields"""
+    from config import Config
+    return Config()
+
+
+def _skip_unless_installed(*modules):
+    """Skip before importing anything heavy if a module needed by a real component is missing"""
+    missing = [name for name in modules if importlib.util.find_spec(name) is None]
+    if missing:
+        pytest.skip(f"{', '.join(missing)} not installed")
+
+
+@pytest.fixture(scope="session")
+def chroma_store():
+    """
+    One VectorStore over the local chroma_db for the integration tests, so the
+    embedding model is loaded once per session. Skips if chroma_db is missing.
+    """
+    chroma_path = os.path.join(os.path.dirname(__file__), "..", "chroma_db")
+    if not os.path.exists(chroma_path):
+        pytest.skip("chroma_db directory not found - server may not have been started yet")
+    _skip_unless_installed("sentence_transformers")
+
+    return VectorStore(
+        chroma_path=chroma_path,
+        embedding_model="all-MiniLM-L6-v2",
+        max_results=5
     )
 
 
+@pytest.fixture(scope="session")
+def live_rag_system():
+    """
+    One RAGSystem over the local chroma_db for the live tests, so the vector
+    store and embedding model are loaded once per session.
+    """
+    chroma_path = os.path.join(os.path.dirname(__file__), "..", "chroma_db")
+    if not os.path.exists(chroma_path):
+        pytest.skip("chroma_db not found")
+    _skip_unless_installed("chromadb", "sentence_transformers")
+
+    # Imported only once the live run is known to proceed
+    from config import config
+    from rag_system import RAGSystem
+
+    try:
+        return RAGSystem(config)
+    except Exception as e:
+        pytest.fail(f"RAGSystem initialization failed: {type(e).__name__}: {e}")
+
+
+@pytest.fixture(autouse=True)
+def _clear_anthropic_clients():
+    """Drop memoized SDK clients so each test sees its own patched Anthropic class"""
+    ai_generator._get_client.cache_clear()
+    ai_generator._get_async_client.cache_clear()
+
+
+@pytest.fixture(scope="session")
+def _anthropic_client_template():
+    """Anthropic client mock with an autospec'd messages resource, built once per session"""
+    client = NonCallableMagicMock(spec=anthropic.Anthropic)
+    client.messages = create_autospec(Messages, instance=True)
+    return client
+
+
 @pytest.fixture
-def empty_search_results():
-    """SearchResults with no documents and no error"""
-    return SearchResults(documents=[], metadata=[], distances=[])
+def anthropic_client_mock(monkeypatch, _anthropic_client_template):
+    """
+    Per-test copy of the client template, returned by every anthropic.Anthropic() call.
+    Deep-copied because a shallow copy would share call records between tests.
+    """
+    client = copy.deepcopy(_anthropic_client_template)
+    monkeypatch.setattr(ai_generator.anthropic, "Anthropic", lambda **_: client)
+    return client
 
 
 @pytest.fixture
-def error_search_results():
-    """SearchResults with an error message"""
-    return SearchResults.empty("No course found matching 'NonExistent'")
+def async_anthropic_client_mock(monkeypatch):
+    """Client mock returned by every anthropic.AsyncAnthropic() call; tests set AsyncMock methods"""
+    client = MagicMock()
+    monkeypatch.setattr(ai_generator.anthropic, "AsyncAnthropic", lambda **_: client)
+    return client
+
+
+@pytest.fixture(scope="module")
+def _module_generator(_anthropic_client_template):
+    """One AIGenerator per test module, wired to its own copy of the client template"""
+    client = copy.deepcopy(_anthropic_client_template)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(ai_generator.anthropic, "Anthropic", lambda **_: client)
+        ai_generator._get_client.cache_clear()
+        generator = ai_generator.AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+    ai_generator._get_client.cache_clear()
+    return generator, client
+
+
+@pytest.fixture
+def shared_generator(_module_generator):
+    """
+    The module's (generator, client mock) pair, with mock state and the
+    generator's caches reset so each test starts clean.
+    """
+    generator, client = _module_generator
+    client.reset_mock(return_value=True, side_effect=True)
+    generator._response_cache.clear()
+    generator._tools_cache.clear()
+    generator._semantic_embeddings = None
+    generator._semantic_groups = None
+    generator._semantic_entries = []
+    generator._semantic_next = 0
+    return generator, client
+
+
+class _MessagesAPIMock:
+    """
+    httpx transport handler standing in for the Messages API.
+    Serves queued response bodies in order and records each parsed request body.
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def queue(self, content, stop_reason="end_turn"):
+        """Queue one Message response with the given content blocks"""
+        self.responses.append({
+            "id": f"msg_{len(self.responses)}",
+            "type": "message",
+            "role": "assistant",
+            "model": "claude-sonnet-4-20250514",
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": 1, "output_tokens": 1},
+        })
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(json.loads(request.content))
+        return httpx.Response(200, json=self.responses.pop(0))
 
 
 @pytest.fixture
+def anthropic_http_mock(monkeypatch):
+    """
+    Route the real Anthropic SDK client through an httpx.MockTransport, so tests
+    exercise request serialization and response parsing without the network.
+    """
+    api = _MessagesAPIMock()
+    http_client = httpx.Client(transport=httpx.MockTransport(api))
+    monkeypatch.setattr(ai_generator, "_get_http_client", lambda: http_client)
+    yield api
+    http_client.close()
+
+
+@dataclass(slots=True)
+class _Block:
+    """Lightweight stand-in for an SDK content block"""
+    type: str
+    text: Optional[str] = None
+    name: Optional[str] = None
+    input: Optional[dict] = None
+    id: Optional[str] = None
+
+
+@dataclass(slots=True)
+class _Resp:
+    """Lightweight stand-in for an SDK Message"""
+    stop_reason: str
+    content: list = field(default_factory=list)
+
+
+# Responses are built directly rather than unpickled from a template:
+# two slotted dataclasses take ~1µs, several times less than pickle.loads
+def _build_text_response(text, stop_reason="end_turn"):
+    """Create an Anthropic API response with text content"""
+    return _Resp(stop_reason=stop_reason, content=[_Block(type="text", text=text)])
+
+
+def _build_tool_use_response(tool_name, tool_input, tool_id="tool_123"):
+    """Create an Anthropic API response with tool_use content"""
+    return _Resp(
+        stop_reason="tool_use",
+        content=[_Block(type="tool_use", name=tool_name, input=tool_input, id=tool_id)]
+    )
+
+
+@pytest.fixture(scope="session")
+def make_text_response():
+    """Factory for fresh text responses, for tests that mutate or compare them"""
+    return _build_text_response
+
+
+@pytest.fixture(scope="session")
+def make_tool_use_response():
+    """Factory for fresh tool_use responses"""
+    return _build_tool_use_response
+
+
+@pytest.fixture(scope="session")
+def text_response_ok():
+    """Shared 'Hello!' end_turn response; do not mutate"""
+    return _build_text_response("Hello!")
+
+
+# Built once at import and shared by every test; SearchResults is a mutable
+# dataclass, so tests that need to modify one must copy it first
+_SAMPLE_RESULTS = SearchResults(
+    documents=[
+        "MCP stands for Model Context Protocol. It allows AI models to interact with external tools.",
+        "The MCP architecture uses a client-server pattern for tool communication."
+    ],
+    metadata=[
+        {"course_title": "Introduction to MCP", "lesson_number": 1, "chunk_index": 0},
+        {"course_title": "Introduction to MCP", "lesson_number": 2, "chunk_index": 3}
+    ],
+    distances=[0.25, 0.42]
+)
+_EMPTY_RESULTS = SearchResults(documents=[], metadata=[], distances=[])
+_ERROR_RESULTS = SearchResults.empty("No course found matching 'NonExistent'")
+
+
+@pytest.fixture(scope="session")
+def sample_search_results():
+    """SearchResults with 2 documents and realistic metadata; shared, do not mutate"""
+    return _SAMPLE_RESULTS
+
+
+@pytest.fixture(scope="session")
+def empty_search_results():
+    """SearchResults with no documents and no error; shared, do not mutate"""
+    return _EMPTY_RESULTS
+
+
+@pytest.fixture(scope="session")
+def error_search_results():
+    """SearchResults with an error message; shared, do not mutate"""
+    return _ERROR_RESULTS
+
+
+class _FakeVectorStore:
+    """
+    Recording stand-in for the VectorStore methods the search tools call.
+    Tests set the *_return / *_exc attributes and assert on search_calls.
+    """
+
+    def __init__(self, search_return):
+        self.reset(search_return)
+
+    def reset(self, search_return):
+        """Drop recorded calls and overrides, restoring the default behavior"""
+        self.search_calls = []
+        self.search_return = search_return
+        self.search_exc = None
+        self.resolve_return = "Introduction to MCP"
+        self.resolve_exc = None
+        self.lesson_link = "https://example.com/lesson/1"
+        self.course_catalog = None
+
+    def search(self, query, course_name=None, lesson_number=None):
+        self.search_calls.append((query, course_name, lesson_number))
+        if self.search_exc:
+            raise self.search_exc
+        return self.search_return
+
+    def _resolve_course_name(self, course_name):
+        if self.resolve_exc:
+            raise self.resolve_exc
+        return self.resolve_return
+
+    def get_lesson_link(self, course_title, lesson_number):
+        return self.lesson_link
+
+    def get_existing_course_titles(self):
+        return ["Introduction to MCP"]
+
+    def get_course_count(self):
+        return 1
+
+
+@pytest.fixture(scope="session")
 def mock_vector_store(sample_search_results):
-    """MagicMock spec'd to VectorStore with default search behavior"""
-    store = MagicMock(spec=VectorStore)
-    store.search.return_value = sample_search_results
-    store.get_lesson_link.return_value = "https://example.com/lesson/1"
-    store._resolve_course_name.return_value = "Introduction to MCP"
-    store.get_existing_course_titles.return_value = ["Introduction to MCP"]
-    store.get_course_count.return_value = 1
-    return store
+    """
+    Fake VectorStore with default search behavior, built once per session.
+    Modules that configure it must use reset_vector_store.
+    """
+    return _FakeVectorStore(sample_search_results)
+
+
+@pytest.fixture
+def reset_vector_store(mock_vector_store, sample_search_results):
+    """Clear the shared store's recorded calls and overrides"""
+    mock_vector_store.reset(sample_search_results)
 
 
 @pytest.fixture
@@ -1,317 +1,867 @@
+import asyncio
+import threading
 import pytest
-from unittest.mock import MagicMock, patch, call
+from unittest.mock import AsyncMock, MagicMock
+import ai_generator
 from ai_generator import AIGenerator
+from search_tools import Tool, ToolManager
 
 
-def _make_text_response(text, stop_reason="end_turn"):
-    """Helper to create a mock Anthropic API response with text content"""
-    content_block = MagicMock()
-    content_block.type = "text"
-    content_block.text = text
-    response = MagicMock()
-    response.stop_reason = stop_reason
-    response.content = [content_block]
-    return response
+# Shared tool definitions; AIGenerator copies before adding cache_control, so never mutated
+_SEARCH_TOOL = {"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}}
+_OUTLINE_TOOL = {"name": "get_course_outline", "description": "test", "input_schema": {"type": "object", "properties": {}}}
 
 
-def _make_tool_use_response(tool_name, tool_input, tool_id="tool_123"):
-    """Helper to create a mock Anthropic API response with tool_use content"""
-    content_block = MagicMock()
-    content_block.type = "tool_use"
-    content_block.name = tool_name
-    content_block.input = tool_input
-    content_block.id = tool_id
-    response = MagicMock()
-    response.stop_reason = "tool_use"
-    response.content = [content_block]
-    return response
+class _StubToolMgr:
+    """Minimal sync tool manager: records execute_tool calls and replays scripted outcomes"""
+
+    def __init__(self, outcomes=(), sources=()):
+        self.calls = []
+        self.restored = []
+        self._outcomes = iter(outcomes)
+        self._sources = list(sources)
+
+    def execute_tool(self, name, **kwargs):
+        self.calls.append((name, kwargs))
+        outcome = next(self._outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def is_stateful(self, name):
+        return False
+
+    def get_last_sources(self):
+        return self._sources
+
+    def restore_sources(self, sources):
+        self.restored.append(sources)
+
+
+def _keyword_embedder(texts):
+    """Fake embedder: keyword counts, so paraphrases embed identically"""
+    keywords = ("mcp", "lesson", "python")
+    return [[text.lower().count(k) for k in keywords] for text in texts]
 
 
 class TestAIGeneratorDirectResponse:
     """Tests for AIGenerator when Claude answers directly (no tool use)"""
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_direct_response_no_tools(self, mock_anthropic_cls):
+    def test_direct_response_no_tools(self, shared_generator, text_response_ok):
         """When stop_reason='end_turn', should return content[0].text"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-        mock_client.messages.create.return_value = _make_text_response("Hello!")
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = text_response_ok
 
-        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
         result = generator.generate_response(query="What is Python?")
 
         assert result == "Hello!"
         mock_client.messages.create.assert_called_once()
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_conversation_history_in_system_prompt(self, mock_anthropic_cls):
+    def test_conversation_history_in_system_prompt(self, shared_generator, make_text_response):
         """System prompt should include conversation history when provided"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-        mock_client.messages.create.return_value = _make_text_response("follow up answer")
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = make_text_response("follow up answer")
 
-        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
         generator.generate_response(
             query="follow up",
             conversation_history="User: hi\nAssistant: hello"
         )
 
         call_kwargs = mock_client.messages.create.call_args
-        system_content = call_kwargs.kwargs.get("system") or call_kwargs[1].get("system")
+        system_blocks = call_kwargs.kwargs["system"]
+        system_content = "\n".join(block["text"] for block in system_blocks)
         assert "User: hi" in system_content
         assert "Assistant: hello" in system_content
         assert "Previous conversation:" in system_content
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_tools_adds_tool_choice_auto(self, mock_anthropic_cls):
+    def test_tools_adds_tool_choice_auto(self, shared_generator, make_text_response):
         """When tools are provided, tool_choice should be set to auto"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-        mock_client.messages.create.return_value = _make_text_response("answer")
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = make_text_response("answer")
 
-        tools = [{"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}}]
+        tools = [_SEARCH_TOOL]
 
-        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
         generator.generate_response(query="test", tools=tools)
 
         call_kwargs = mock_client.messages.create.call_args
-        kwargs = call_kwargs.kwargs if call_kwargs.kwargs else call_kwargs[1]
+        kwargs = call_kwargs.kwargs
         assert kwargs["tool_choice"] == {"type": "auto"}
-        assert kwargs["tools"] == tools
+        assert [t["name"] for t in kwargs["tools"]] == ["search_course_content"]
+
+    def test_static_prefix_marked_for_caching(self, shared_generator, make_text_response):
+        """System prompt and last tool get cache_control; history and caller's tools do not"""
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = make_text_response("answer")
+
+        tools = [_SEARCH_TOOL]
+
+        generator.generate_response(
+            query="test", conversation_history="User: hi", tools=tools
+        )
+
+        kwargs = mock_client.messages.create.call_args.kwargs
+        core, tool_hint, history = kwargs["system"]
+        assert core["text"] == AIGenerator.SYSTEM_PROMPT_CORE
+        assert tool_hint["text"] == AIGenerator.SYSTEM_PROMPT_TOOL_HINT
+        assert tool_hint["cache_control"] == {"type": "ephemeral"}
+        assert "cache_control" not in history
+        assert kwargs["tools"][-1]["cache_control"] == {"type": "ephemeral"}
+        # The caller's tool definitions must not be mutated
+        assert "cache_control" not in tools[0]
+
+
+    @pytest.mark.parametrize(
+        "query",
+        [
+            pytest.param("Show me the outline of the MCP course", id="outline"),
+            pytest.param("What is MCP?", id="content"),
+            pytest.param("What does the course cover?", id="overview"),
+            pytest.param("What lessons are in MCP and what does lesson 2 say about tools?", id="outline_then_search"),
+        ],
+    )
+    def test_all_tools_offered_by_default(self, shared_generator, make_text_response, query):
+        """Without a tool_selector every tool is offered, so outline-then-search stays possible"""
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = make_text_response("answer")
+
+        generator.generate_response(query=query, tools=[_SEARCH_TOOL, _OUTLINE_TOOL])
+
+        offered = mock_client.messages.create.call_args.kwargs["tools"]
+        assert [t["name"] for t in offered] == ["search_course_content", "get_course_outline"]
+
+    def test_custom_tool_selector(self, anthropic_client_mock, make_text_response):
+        """A constructor-injected selector should pick the tools offered"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.return_value = make_text_response("answer")
+
+        tools = [{"name": "a"}, {"name": "b"}]
+        selector = MagicMock(return_value=tools[:1])
+
+        generator = AIGenerator(
+            api_key="test-key", model="claude-sonnet-4-20250514", tool_selector=selector
+        )
+        generator.generate_response(query="What is MCP?", tools=tools)
+
+        selector.assert_called_once_with("What is MCP?", tools)
+        assert [t["name"] for t in mock_client.messages.create.call_args.kwargs["tools"]] == ["a"]
+
+    def test_marked_tools_memoized(self, shared_generator, make_text_response):
+        """Requests sharing tool definitions should send one shared cache-marked list"""
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = make_text_response("answer")
+
+        tools = [_SEARCH_TOOL]
+
+        generator.generate_response(query="What is MCP?", tools=tools)
+        generator.generate_response(query="What is Python?", tools=tools)
+
+        first, second = mock_client.messages.create.call_args_list
+        assert first.kwargs["tools"] is second.kwargs["tools"]
+
+    def test_system_blocks_memoized_per_history(self):
+        """System blocks should be built once per distinct history string"""
+        history = "User: hi\nAssistant: hello"
+
+        assert AIGenerator._build_system(history, True) is AIGenerator._build_system(history, True)
+        assert AIGenerator._build_system(None, True) is not AIGenerator._build_system(history, True)
+
+    def test_tool_hint_only_sent_with_tools(self):
+        """Tool instructions should be omitted from the system prompt when no tools are offered"""
+        assert AIGenerator._build_system(None, False) == [AIGenerator.CORE_BLOCK]
+        assert AIGenerator._build_system(None, True) == [
+            AIGenerator.CORE_BLOCK, AIGenerator.TOOL_HINT_BLOCK
+        ]
 
 
 class TestAIGeneratorToolExecution:
     """Tests for AIGenerator tool-use round-trip behavior"""
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_tool_use_round_trip(self, mock_anthropic_cls):
-        """Full tool-use flow: Claude requests tool -> execute -> send results -> get final answer"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-
-        # First call: Claude wants to use a tool
-        tool_response = _make_tool_use_response(
-            "search_course_content",
-            {"query": "MCP basics"},
-            "tool_123"
+    @pytest.mark.parametrize(
+        "script, tool_outcomes, expected_result, tools_offered",
+        [
+            pytest.param(
+                [("tool_use", "search_course_content", {"query": "MCP basics"}, "tool_123"),
+                 ("text", "Here is what I found about MCP...")],
+                ["[Introduction to MCP - Lesson 1]\nMCP content here"],
+                "Here is what I found about MCP...",
+                # Tools stay offered on the follow-up (round 0 < MAX_TOOL_ROUNDS - 1)
+                (True, True),
+                id="round_trip",
+            ),
+            pytest.param(
+                [("tool_use", "get_course_outline", {"course_name": "MCP"}, "tool_1"),
+                 ("tool_use", "search_course_content", {"query": "lesson 3 topics"}, "tool_2"),
+                 ("text", "Lesson 3 covers X, Y, Z.")],
+                ["Lesson 1: Intro\nLesson 2: Basics\nLesson 3: Advanced", "Lesson 3 content about X, Y, Z"],
+                "Lesson 3 covers X, Y, Z.",
+                # The final call after MAX_TOOL_ROUNDS omits tools
+                (True, True, False),
+                id="two_rounds",
+            ),
+            pytest.param(
+                [("tool_use", "search_course_content", {"query": "a"}, "t1"),
+                 ("tool_use", "search_course_content", {"query": "b"}, "t2"),
+                 ("tool_use", "search_course_content", {"query": "c"}, "t3")],
+                ["results", "results"],
+                # The final response has no text block
+                AIGenerator.FALLBACK_RESPONSE,
+                (True, True, False),
+                id="max_rounds_terminates",
+            ),
+            pytest.param(
+                [("tool_use", "search_course_content", {"query": "test"}, "tool_err"),
+                 ("text", "Sorry, I encountered an error searching.")],
+                [Exception("Connection timeout")],
+                "Sorry, I encountered an error searching.",
+                # After an error, one final call without tools, then the loop stops
+                (True, False),
+                id="tool_error_stops_loop",
+            ),
+        ],
+    )
+    def test_tool_loop(self, shared_generator, make_text_response, make_tool_use_response,
+                       script, tool_outcomes, expected_result, tools_offered):
+        """Scripted tool-use conversations: rounds, tool results, and per-call tool offering"""
+        generator, mock_client = shared_generator
+        mock_client.messages.create.side_effect = iter(tuple(
+            make_tool_use_response(*step[1:]) if step[0] == "tool_use" else make_text_response(step[1])
+            for step in script
+        ))
+
+        tool_manager = _StubToolMgr(tool_outcomes)
+
+        tools = [_OUTLINE_TOOL, _SEARCH_TOOL]
+
+        result = generator.generate_response(
+            query="What topics does lesson 3 cover?", tools=tools, tool_manager=tool_manager
         )
-        # Second call: Claude synthesizes the answer
-        final_response = _make_text_response("Here is what I found about MCP...")
 
-        mock_client.messages.create.side_effect = [tool_response, final_response]
+        assert result == expected_result
 
-        # Mock tool manager
-        mock_tool_manager = MagicMock()
-        mock_tool_manager.execute_tool.return_value = "[Introduction to MCP - Lesson 1]\nMCP content here"
+        # One execution per tool round, with the block's name and input
+        rounds = script[:len(tool_outcomes)]
+        assert tool_manager.calls == [(name, tool_input) for _, name, tool_input, _ in rounds]
 
-        tools = [{"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}}]
+        create_calls = mock_client.messages.create.call_args_list
+        assert [("tools" in c.kwargs) for c in create_calls] == list(tools_offered)
+        # Synthesis rounds get a smaller token budget than the initial call
+        assert [c.kwargs["max_tokens"] for c in create_calls] == (
+            [AIGenerator.MAX_TOKENS] + [AIGenerator.SYNTHESIS_MAX_TOKENS] * len(rounds)
+        )
+
+        # user, then one (assistant tool_use, user tool_result) pair per round
+        messages = create_calls[-1].kwargs["messages"]
+        assert [m["role"] for m in messages] == ["user"] + ["assistant", "user"] * len(rounds)
+        for i, ((_, name, tool_input, tool_id), outcome) in enumerate(zip(rounds, tool_outcomes)):
+            # Assistant turns are re-sent as plain dicts
+            assert messages[1 + 2 * i]["content"] == [
+                {"type": "tool_use", "id": tool_id, "name": name, "input": tool_input}
+            ]
+            tool_result = messages[2 + 2 * i]["content"][0]
+            assert tool_result["type"] == "tool_result"
+            assert tool_result["tool_use_id"] == tool_id
+            if isinstance(outcome, Exception):
+                assert tool_result["is_error"] is True
+                assert str(outcome) in tool_result["content"]
+            else:
+                assert tool_result["content"] == outcome
+
+    def test_tool_use_stop_without_tool_blocks_skips_follow_up(self, shared_generator, make_text_response):
+        """stop_reason='tool_use' with no tool_use blocks should not trigger a follow-up call"""
+        generator, mock_client = shared_generator
+        mock_client.messages.create.return_value = make_text_response("Direct answer", stop_reason="tool_use")
+
+        tool_manager = _StubToolMgr()
 
-        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
         result = generator.generate_response(
-            query="Tell me about MCP",
-            tools=tools,
-            tool_manager=mock_tool_manager
+            query="test", tools=[{"name": "x"}], tool_manager=tool_manager
         )
 
-        # Verify result
-        assert result == "Here is what I found about MCP..."
+        assert result == "Direct answer"
+        mock_client.messages.create.assert_called_once()
+        assert tool_manager.calls == []
+
+    def test_parallel_tool_calls_in_one_turn(self, shared_generator, make_text_response, make_tool_use_response):
+        """Multiple tool_use blocks in one turn run concurrently via ToolManager; results keep block order"""
+        generator, mock_client = shared_generator
+
+        outline_block = make_tool_use_response("get_course_outline", {"course_name": "MCP"}, "t1").content[0]
+        search_block = make_tool_use_response("search_course_content", {"query": "MCP"}, "t2").content[0]
+        tool_response = make_tool_use_response("unused", {})
+        tool_response.content = [outline_block, search_block]
+
+        mock_client.messages.create.side_effect = [tool_response, make_text_response("Done")]
+
+        # Both calls must be in flight at once to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+
+        class BarrierTool(Tool):
+            def __init__(self, name):
+                self.name = name
+
+            def get_tool_definition(self):
+                return {"name": self.name}
+
+            def execute(self, **kwargs):
+                barrier.wait()
+                return f"{self.name} result"
+
+        tool_manager = ToolManager()
+        tool_manager.register_tool(BarrierTool("get_course_outline"))
+        tool_manager.register_tool(BarrierTool("search_course_content"))
 
-        # Verify tool was executed
-        mock_tool_manager.execute_tool.assert_called_once_with(
-            "search_course_content", query="MCP basics"
+        result = generator.generate_response(
+            query="test", tools=[{"name": "x"}], tool_manager=tool_manager
         )
 
-        # Verify two API calls were made
+        assert result == "Done"
+        tool_results = mock_client.messages.create.call_args_list[1].kwargs["messages"][-1]["content"]
+        assert [r["tool_use_id"] for r in tool_results] == ["t1", "t2"]
+        assert [r["content"] for r in tool_results] == [
+            "get_course_outline result", "search_course_content result"
+        ]
+        assert not any(r.get("is_error") for r in tool_results)
+
+    def test_duplicate_tool_calls_executed_once(self, shared_generator, make_text_response, make_tool_use_response):
+        """Identical calls in one turn run once; each tool_use_id still gets a result"""
+        generator, mock_client = shared_generator
+
+        first = make_tool_use_response("search_course_content", {"query": "MCP", "course_name": "Intro"}, "t1").content[0]
+        second = make_tool_use_response("search_course_content", {"course_name": "Intro", "query": "MCP"}, "t2").content[0]
+        tool_response = make_tool_use_response("unused", {})
+        tool_response.content = [first, second]
+
+        mock_client.messages.create.side_effect = [tool_response, make_text_response("Done")]
+
+        tool_manager = _StubToolMgr(["MCP content"])
+
+        generator.generate_response(query="test", tools=[{"name": "x"}], tool_manager=tool_manager)
+
+        assert tool_manager.calls == [("search_course_content", {"query": "MCP", "course_name": "Intro"})]
+        tool_results = mock_client.messages.create.call_args_list[1].kwargs["messages"][-1]["content"]
+        assert [(r["tool_use_id"], r["content"]) for r in tool_results] == [
+            ("t1", "MCP content"), ("t2", "MCP content")
+        ]
+
+    def test_round_dispatched_as_one_batch(self, shared_generator, make_text_response, make_tool_use_response):
+        """A tool_manager with execute_tools should get the whole round in one call"""
+        generator, mock_client = shared_generator
+
+        outline_block = make_tool_use_response("get_course_outline", {"course_name": "MCP"}, "t1").content[0]
+        search_block = make_tool_use_response("search_course_content", {"query": "MCP"}, "t2").content[0]
+        tool_response = make_tool_use_response("unused", {})
+        tool_response.content = [outline_block, search_block]
+
+        mock_client.messages.create.side_effect = [tool_response, make_text_response("Done")]
+
+        class BatchToolManager:
+            def __init__(self):
+                self.batches = []
+
+            def execute_tools(self, calls):
+                self.batches.append(calls)
+                return ["outline", ValueError("boom")]
+
+        tool_manager = BatchToolManager()
+        generator.generate_response(query="test", tools=[{"name": "x"}], tool_manager=tool_manager)
+
+        assert tool_manager.batches == [[
+            ("get_course_outline", {"course_name": "MCP"}),
+            ("search_course_content", {"query": "MCP"}),
+        ]]
+        tool_results = mock_client.messages.create.call_args_list[1].kwargs["messages"][-1]["content"]
+        assert tool_results[0]["content"] == "outline"
+        assert tool_results[1]["is_error"] is True
+
+    def test_api_error_propagates(self, anthropic_client_mock):
+        """Anthropic API errors should propagate (no try/except in AIGenerator)"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = Exception("401 Unauthorized: Invalid API key")
+
+        generator = AIGenerator(api_key="bad-key", model="claude-sonnet-4-20250514")
+
+        with pytest.raises(Exception, match="401 Unauthorized"):
+            generator.generate_response(query="test")
+
+    def test_generators_share_http_client(self, monkeypatch):
+        """All AIGenerator instances should reuse one pooled HTTP client"""
+        mock_anthropic_cls = MagicMock()
+        monkeypatch.setattr(ai_generator.anthropic, "Anthropic", mock_anthropic_cls)
+        AIGenerator(api_key="key-a", model="claude-sonnet-4-20250514")
+        AIGenerator(api_key="key-b", model="claude-sonnet-4-20250514")
+
+        first, second = mock_anthropic_cls.call_args_list
+        assert first.kwargs["http_client"] is second.kwargs["http_client"]
+
+    def test_client_reused_per_api_key(self, monkeypatch):
+        """Generators with the same api_key should share one SDK client"""
+        mock_anthropic_cls = MagicMock()
+        monkeypatch.setattr(ai_generator.anthropic, "Anthropic", mock_anthropic_cls)
+        first = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        second = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+
+        assert first.client is second.client
+        mock_anthropic_cls.assert_called_once()
+
+    def test_empty_api_key_creates_client(self, anthropic_client_mock):
+        """AIGenerator with empty api_key should still construct, but fail on API call"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = Exception("Authentication error: API key is empty")
+
+        generator = AIGenerator(api_key="", model="claude-sonnet-4-20250514")
+
+        with pytest.raises(Exception, match="Authentication error"):
+            generator.generate_response(query="test")
+
+
+class TestAIGeneratorResponseCache:
+    """Tests for the exact-match response cache in generate_response"""
+
+    def test_repeat_query_served_from_cache(self, anthropic_client_mock, make_text_response, make_tool_use_response):
+        """Same query/history/tools should skip the API and restore the original sources"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = [
+            make_tool_use_response("search_course_content", {"query": "MCP"}, "t1"),
+            make_text_response("MCP answer"),
+        ]
+
+        tool_manager = _StubToolMgr(["results"], sources=[{"label": "MCP - Lesson 1", "url": None}])
+
+        tools = [_SEARCH_TOOL]
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        first = generator.generate_response(query="What is MCP?", tools=tools, tool_manager=tool_manager)
+        second = generator.generate_response(query="  what is mcp?", tools=tools, tool_manager=tool_manager)
+
+        assert first == second == "MCP answer"
         assert mock_client.messages.create.call_count == 2
+        assert len(tool_manager.calls) == 1
+        assert tool_manager.restored == [[{"label": "MCP - Lesson 1", "url": None}]]
+
+    def test_tool_manager_with_only_execute_tool(self, anthropic_client_mock, make_text_response, make_tool_use_response):
+        """A duck-typed tool manager without the optional methods should still work, cached or not"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = [
+            make_tool_use_response("search_course_content", {"query": "MCP"}, "t1"),
+            make_text_response("MCP answer"),
+        ]
 
-        # Verify second call includes tool result and tools (for possible second round)
-        second_call_kwargs = mock_client.messages.create.call_args_list[1]
-        kwargs = second_call_kwargs.kwargs if second_call_kwargs.kwargs else second_call_kwargs[1]
-        messages = kwargs["messages"]
-        # Last message should be the tool result
-        tool_result_msg = messages[-1]
-        assert tool_result_msg["role"] == "user"
-        assert tool_result_msg["content"][0]["type"] == "tool_result"
-        assert tool_result_msg["content"][0]["tool_use_id"] == "tool_123"
-        # Tools should be included (round 0 < MAX_TOOL_ROUNDS - 1)
-        assert "tools" in kwargs
-
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_two_round_tool_use(self, mock_anthropic_cls):
-        """Two sequential tool calls: tool_use -> tool_use -> text response"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-
-        # Round 1: Claude calls get_course_outline
-        first_tool = _make_tool_use_response(
-            "get_course_outline", {"course_name": "MCP"}, "tool_1"
-        )
-        # Round 2: Claude calls search_course_content
-        second_tool = _make_tool_use_response(
-            "search_course_content", {"query": "lesson 3 topics"}, "tool_2"
+        class MinimalToolManager:
+            def execute_tool(self, name, **kwargs):
+                return "results"
+
+        tool_manager = MinimalToolManager()
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        first = generator.generate_response(query="What is MCP?", tools=[_SEARCH_TOOL], tool_manager=tool_manager)
+        second = generator.generate_response(query="What is MCP?", tools=[_SEARCH_TOOL], tool_manager=tool_manager)
+
+        assert first == second == "MCP answer"
+        assert mock_client.messages.create.call_count == 2
+
+    @pytest.mark.parametrize(
+        "stateful, expected",
+        [
+            pytest.param(False, True, id="stateless_tools"),
+            pytest.param(True, False, id="stateful_tool"),
+            # Without is_stateful every tool counts as stateful
+            pytest.param(None, False, id="no_is_stateful"),
+        ],
+    )
+    def test_can_coalesce(self, stateful, expected):
+        """Requests are only coalesced when no offered tool is stateful"""
+        tool_manager = _StubToolMgr()
+        if stateful is None:
+            tool_manager = object()
+        elif stateful:
+            tool_manager.is_stateful = lambda name: name == "get_course_outline"
+
+        assert AIGenerator._can_coalesce([_SEARCH_TOOL, _OUTLINE_TOOL], tool_manager) is expected
+        assert AIGenerator._can_coalesce(None, tool_manager) is True
+
+    def test_identical_concurrent_requests_share_one_call(self, anthropic_client_mock, make_text_response):
+        """Identical requests from two threads should share the first one's API call"""
+        mock_client = anthropic_client_mock
+        entered, release = threading.Event(), threading.Event()
+
+        def create(**kwargs):
+            entered.set()
+            release.wait(timeout=1)
+            # Not cacheable, so the second caller can only get it by coalescing
+            return make_text_response("Shared answer", stop_reason="max_tokens")
+
+        mock_client.messages.create.side_effect = create
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        results = []
+
+        def ask():
+            results.append(generator.generate_response(query="What is MCP?"))
+
+        leader = threading.Thread(target=ask)
+        leader.start()
+        entered.wait(timeout=1)
+        follower = threading.Thread(target=ask)
+        follower.start()
+        # Give the follower time to find the in-flight request and start waiting
+        follower.join(timeout=0.1)
+        release.set()
+        leader.join()
+        follower.join()
+
+        assert results == ["Shared answer", "Shared answer"]
+        mock_client.messages.create.assert_called_once()
+        assert generator._inflight == {}
+
+    def test_use_cache_false_bypasses_cache(self, anthropic_client_mock, text_response_ok):
+        """use_cache=False should always call the API"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.return_value = text_response_ok
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        generator.generate_response(query="hi", use_cache=False)
+        generator.generate_response(query="hi", use_cache=False)
+
+        assert mock_client.messages.create.call_count == 2
+
+    def test_answer_after_tool_error_not_cached(self, anthropic_client_mock, make_text_response, make_tool_use_response):
+        """Responses produced after a failed tool call should not be cached"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = [
+            make_tool_use_response("search_course_content", {"query": "x"}, "t1"),
+            make_text_response("Sorry, search failed."),
+            make_text_response("Recovered answer"),
+        ]
+
+        tool_manager = _StubToolMgr([Exception("Connection timeout")])
+
+        tools = [_SEARCH_TOOL]
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        generator.generate_response(query="x", tools=tools, tool_manager=tool_manager)
+        result = generator.generate_response(query="x", tools=tools, tool_manager=tool_manager)
+
+        assert result == "Recovered answer"
+        assert mock_client.messages.create.call_count == 3
+
+
+    def test_paraphrased_query_served_from_semantic_cache(self, anthropic_client_mock, make_text_response):
+        """A near-duplicate query should reuse the cached answer when an embedder is set"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.return_value = make_text_response("MCP answer")
+
+        generator = AIGenerator(
+            api_key="test-key", model="claude-sonnet-4-20250514", embedder=_keyword_embedder
         )
-        # Final: text response
-        final = _make_text_response("Lesson 3 covers X, Y, Z.")
+        generator.generate_response(query="What is MCP?")
+        result = generator.generate_response(query="Explain MCP to me")
 
-        mock_client.messages.create.side_effect = [first_tool, second_tool, final]
+        assert result == "MCP answer"
+        mock_client.messages.create.assert_called_once()
 
-        mock_tool_manager = MagicMock()
-        mock_tool_manager.execute_tool.side_effect = [
-            "Lesson 1: Intro\nLesson 2: Basics\nLesson 3: Advanced",
-            "Lesson 3 content about X, Y, Z"
+    def test_semantic_cache_requires_matching_numbers(self, anthropic_client_mock, make_text_response):
+        """Similar queries about different lesson numbers must not share an answer"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = [
+            make_text_response("Lesson 1 answer"),
+            make_text_response("Lesson 2 answer"),
         ]
 
-        tools = [
-            {"name": "get_course_outline", "description": "test", "input_schema": {"type": "object", "properties": {}}},
-            {"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}},
+        generator = AIGenerator(
+            api_key="test-key", model="claude-sonnet-4-20250514", embedder=_keyword_embedder
+        )
+        generator.generate_response(query="MCP lesson 1")
+        result = generator.generate_response(query="MCP lesson 2")
+
+        assert result == "Lesson 2 answer"
+        assert mock_client.messages.create.call_count == 2
+
+    def test_semantic_cache_embeds_question_without_history(self, anthropic_client_mock, make_text_response):
+        """A long history must not make different questions embed alike in a truncating embedder"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = [
+            make_text_response("MCP answer"),
+            make_text_response("Python answer"),
         ]
 
-        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
-        result = generator.generate_response(
-            query="What topics does lesson 3 cover?",
-            tools=tools,
-            tool_manager=mock_tool_manager
+        def truncating_embedder(texts):
+            # Like a model with a fixed input window: only the first 40 characters count
+            return _keyword_embedder([text[:40] for text in texts])
+
+        generator = AIGenerator(
+            api_key="test-key", model="claude-sonnet-4-20250514", embedder=truncating_embedder
         )
+        history = "User: Tell me about the MCP course\nAssistant: It covers MCP servers."
+        generator.generate_response(query="Tell me about MCP", conversation_history=history)
+        result = generator.generate_response(query="Tell me about Python", conversation_history=history)
 
-        assert result == "Lesson 3 covers X, Y, Z."
-        assert mock_tool_manager.execute_tool.call_count == 2
-        assert mock_client.messages.create.call_count == 3
+        assert result == "Python answer"
+        assert mock_client.messages.create.call_count == 2
 
-        # Verify message structure: user, assistant(tool1), tool_result1, assistant(tool2), tool_result2
-        final_call_kwargs = mock_client.messages.create.call_args_list[2]
-        kwargs = final_call_kwargs.kwargs if final_call_kwargs.kwargs else final_call_kwargs[1]
-        messages = kwargs["messages"]
-        assert len(messages) == 5
-        assert messages[0]["role"] == "user"
-        assert messages[1]["role"] == "assistant"
-        assert messages[2]["role"] == "user"  # tool_result 1
-        assert messages[3]["role"] == "assistant"
-        assert messages[4]["role"] == "user"  # tool_result 2
+    def test_semantic_cache_requires_same_history(self, anthropic_client_mock, make_text_response):
+        """A paraphrase should only reuse the answer given under the same history"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.create.side_effect = [
+            make_text_response("Answer after A"),
+            make_text_response("Answer after B"),
+        ]
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_max_rounds_terminates(self, mock_anthropic_cls):
-        """Loop should stop after MAX_TOOL_ROUNDS even if Claude keeps requesting tools"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
+        generator = AIGenerator(
+            api_key="test-key", model="claude-sonnet-4-20250514", embedder=_keyword_embedder
+        )
+        generator.generate_response(query="What is MCP?", conversation_history="User: A")
+        generator.generate_response(query="What is MCP?", conversation_history="User: B")
+        result = generator.generate_response(query="Explain MCP to me", conversation_history="User: B")
 
-        # All responses request tools (more than MAX_TOOL_ROUNDS)
-        tool1 = _make_tool_use_response("search_course_content", {"query": "a"}, "t1")
-        tool2 = _make_tool_use_response("search_course_content", {"query": "b"}, "t2")
-        # Third response also requests tool, but loop should have ended
-        tool3 = _make_tool_use_response("search_course_content", {"query": "c"}, "t3")
+        assert result == "Answer after B"
+        assert mock_client.messages.create.call_count == 2
 
-        mock_client.messages.create.side_effect = [tool1, tool2, tool3]
 
-        mock_tool_manager = MagicMock()
-        mock_tool_manager.execute_tool.return_value = "results"
+class TestAIGeneratorHTTP:
+    """Tests that drive the real Anthropic SDK against a mocked HTTP transport"""
 
-        tools = [{"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}}]
+    def test_tool_round_trip_over_http(self, anthropic_http_mock):
+        """Request bodies built by AIGenerator should serialize and parse through the SDK"""
+        anthropic_http_mock.queue(
+            [{"type": "tool_use", "id": "toolu_1", "name": "search_course_content", "input": {"query": "MCP"}}],
+            stop_reason="tool_use",
+        )
+        anthropic_http_mock.queue([{"type": "text", "text": "MCP is a protocol."}])
+        tool_manager = _StubToolMgr(["MCP content"])
 
         generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
         result = generator.generate_response(
-            query="test", tools=tools, tool_manager=mock_tool_manager
+            query="What is MCP?", tools=[_SEARCH_TOOL], tool_manager=tool_manager
         )
 
-        # Should return fallback since the final response has no text block
-        assert result == "I'm sorry, I wasn't able to generate a response. Please try again."
-        # Only 2 tool executions (MAX_TOOL_ROUNDS)
-        assert mock_tool_manager.execute_tool.call_count == 2
-        # 3 API calls: initial + 2 follow-ups
-        assert mock_client.messages.create.call_count == 3
+        assert result == "MCP is a protocol."
+        first, second = anthropic_http_mock.requests
+        assert first["tools"][-1]["cache_control"] == {"type": "ephemeral"}
+        assert first["max_tokens"] == AIGenerator.MAX_TOKENS
+        assert second["messages"][1:] == [
+            {"role": "assistant", "content": [
+                {"type": "tool_use", "id": "toolu_1", "name": "search_course_content", "input": {"query": "MCP"}}
+            ]},
+            {"role": "user", "content": [
+                {"type": "tool_result", "tool_use_id": "toolu_1", "content": "MCP content"}
+            ]},
+        ]
+
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_tool_error_stops_loop(self, mock_anthropic_cls):
-        """If execute_tool raises, error is sent as tool_result, one final call without tools, then loop stops"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
+def _make_stream(final_response, chunks=()):
+    """Helper to create a mock MessageStream context manager"""
+    stream = MagicMock()
+    stream.text_stream = iter(chunks)
+    stream.get_final_message.return_value = final_response
+    manager = MagicMock()
+    manager.__enter__.return_value = stream
+    return manager
 
-        tool_response = _make_tool_use_response(
-            "search_course_content", {"query": "test"}, "tool_err"
+
+class TestAIGeneratorStreaming:
+    """Tests for stream_response"""
+
+    def test_stream_yields_text_chunks(self, anthropic_client_mock, make_text_response):
+        """Text deltas should be yielded as they arrive"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.stream.return_value = _make_stream(
+            make_text_response("Hello there"), ["Hello", " there"]
         )
-        error_reply = _make_text_response("Sorry, I encountered an error searching.")
 
-        mock_client.messages.create.side_effect = [tool_response, error_reply]
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        chunks = list(generator.stream_response(query="hi"))
 
-        mock_tool_manager = MagicMock()
-        mock_tool_manager.execute_tool.side_effect = Exception("Connection timeout")
+        assert chunks == ["Hello", " there"]
+        mock_client.messages.create.assert_not_called()
+
+    def test_stream_runs_tool_round(self, anthropic_client_mock, make_text_response, make_tool_use_response):
+        """A streamed tool_use response should run tools, then stream the follow-up"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.stream.side_effect = [
+            _make_stream(make_tool_use_response("search_course_content", {"query": "MCP"}, "t1")),
+            _make_stream(make_text_response("MCP is..."), ["MCP ", "is..."]),
+        ]
 
-        tools = [{"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}}]
+        tool_manager = _StubToolMgr(["results"])
+
+        tools = [_SEARCH_TOOL]
 
         generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
-        result = generator.generate_response(
-            query="test", tools=tools, tool_manager=mock_tool_manager
+        chunks = list(generator.stream_response(
+            query="What is MCP?", tools=tools, tool_manager=tool_manager
+        ))
+
+        # The follow-up still offers tools but streams live; no text to discard
+        assert chunks == ["MCP ", "is..."]
+        assert tool_manager.calls == [("search_course_content", {"query": "MCP"})]
+        messages = mock_client.messages.stream.call_args_list[1].kwargs["messages"]
+        assert messages[-1]["content"][0]["tool_use_id"] == "t1"
+
+    def test_stream_discards_text_before_tool_call(self, anthropic_client_mock, make_text_response, make_tool_use_response):
+        """Text preceding a tool call is streamed, then marked for discard before the answer"""
+        mock_client = anthropic_client_mock
+        tool_response = make_tool_use_response("search_course_content", {"query": "MCP"}, "t1")
+        tool_response.content.insert(0, make_text_response("Let me search.").content[0])
+        mock_client.messages.stream.side_effect = [
+            _make_stream(tool_response, ["Let me search."]),
+            _make_stream(make_text_response("Answer."), ["Answer."]),
+        ]
+
+        tool_manager = _StubToolMgr(["results"])
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+
+        def ask():
+            return list(generator.stream_response(
+                query="What is MCP?", tools=[_SEARCH_TOOL], tool_manager=tool_manager
+            ))
+
+        assert ask() == ["Let me search.", ai_generator.STREAM_DISCARD, "Answer."]
+        # Only the answer was cached, so a repeat serves just that
+        assert ask() == ["Answer."]
+        assert mock_client.messages.stream.call_count == 2
+
+    def test_stream_direct_answer_with_tools_is_live(self, anthropic_client_mock, make_text_response):
+        """A direct answer to a request offering tools should stream as it arrives"""
+        mock_client = anthropic_client_mock
+        mock_client.messages.stream.return_value = _make_stream(
+            make_text_response("Python is a language"), ["Python ", "is a language"]
         )
 
-        # After error, a follow-up call is made without tools so Claude can respond
-        assert result == "Sorry, I encountered an error searching."
-        assert mock_client.messages.create.call_count == 2
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        chunks = list(generator.stream_response(
+            query="What is Python?", tools=[_SEARCH_TOOL], tool_manager=_StubToolMgr()
+        ))
 
-        # The follow-up call should not include tools
-        second_call_kwargs = mock_client.messages.create.call_args_list[1]
-        kwargs = second_call_kwargs.kwargs if second_call_kwargs.kwargs else second_call_kwargs[1]
-        assert "tools" not in kwargs
+        assert chunks == ["Python ", "is a language"]
+        assert "tools" in mock_client.messages.stream.call_args.kwargs
 
-        # The error tool_result should be in the messages
-        messages = kwargs["messages"]
-        tool_result_msg = messages[-1]
-        assert tool_result_msg["role"] == "user"
-        assert tool_result_msg["content"][0]["is_error"] is True
-        assert "Connection timeout" in tool_result_msg["content"][0]["content"]
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_final_call_omits_tools(self, mock_anthropic_cls):
-        """After 2 tool rounds, the 3rd API call should NOT include tools"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
+class TestAIGeneratorAsync:
+    """Tests for the AsyncAnthropic-backed agenerate_response path"""
 
-        tool1 = _make_tool_use_response("search_course_content", {"query": "a"}, "t1")
-        tool2 = _make_tool_use_response("search_course_content", {"query": "b"}, "t2")
-        final = _make_text_response("Final answer")
+    def test_async_direct_response(self, async_anthropic_client_mock, text_response_ok):
+        """agenerate_response should await the async client and return its text"""
+        mock_aclient = async_anthropic_client_mock
+        mock_aclient.messages.create = AsyncMock(return_value=text_response_ok)
 
-        mock_client.messages.create.side_effect = [tool1, tool2, final]
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+        result = asyncio.run(generator.agenerate_response(query="What is Python?"))
 
-        mock_tool_manager = MagicMock()
-        mock_tool_manager.execute_tool.return_value = "results"
+        assert result == "Hello!"
+        mock_aclient.messages.create.assert_awaited_once()
 
-        tools = [{"name": "search_course_content", "description": "test", "input_schema": {"type": "object", "properties": {}}}]
+    def test_async_tool_round_trip_runs_sync_tool_manager(self, async_anthropic_client_mock, make_text_response, make_tool_use_response):
+        """A sync-only tool_manager should still be executed on the async path"""
+        mock_aclient = async_anthropic_client_mock
+        mock_aclient.messages.create = AsyncMock(side_effect=[
+            make_tool_use_response("search_course_content", {"query": "MCP basics"}, "tool_123"),
+            make_text_response("Here is what I found about MCP..."),
+        ])
+
+        tool_manager = _StubToolMgr(["MCP content here"])
+
+        tools = [_SEARCH_TOOL]
 
         generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
-        result = generator.generate_response(
-            query="test", tools=tools, tool_manager=mock_tool_manager
-        )
+        result = asyncio.run(generator.agenerate_response(
+            query="Tell me about MCP", tools=tools, tool_manager=tool_manager
+        ))
 
-        assert result == "Final answer"
+        assert result == "Here is what I found about MCP..."
+        assert tool_manager.calls == [("search_course_content", {"query": "MCP basics"})]
+        messages = mock_aclient.messages.create.call_args_list[1].kwargs["messages"]
+        assert messages[-1]["content"][0]["tool_use_id"] == "tool_123"
 
-        # The third (final) API call should NOT include tools
-        third_call_kwargs = mock_client.messages.create.call_args_list[2]
-        kwargs = third_call_kwargs.kwargs if third_call_kwargs.kwargs else third_call_kwargs[1]
-        assert "tools" not in kwargs
+    def test_identical_concurrent_requests_share_one_call(self, async_anthropic_client_mock, make_text_response):
+        """Concurrent identical requests should be coalesced into a single API call"""
+        mock_aclient = async_anthropic_client_mock
 
-        # The second API call SHOULD include tools (round 0 < MAX_TOOL_ROUNDS - 1)
-        second_call_kwargs = mock_client.messages.create.call_args_list[1]
-        kwargs2 = second_call_kwargs.kwargs if second_call_kwargs.kwargs else second_call_kwargs[1]
-        assert "tools" in kwargs2
+        async def create(**kwargs):
+            await asyncio.sleep(0.01)
+            return make_text_response("Shared answer")
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_api_error_propagates(self, mock_anthropic_cls):
-        """Anthropic API errors should propagate (no try/except in AIGenerator)"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-        mock_client.messages.create.side_effect = Exception("401 Unauthorized: Invalid API key")
+        mock_aclient.messages.create = AsyncMock(side_effect=create)
 
-        generator = AIGenerator(api_key="bad-key", model="claude-sonnet-4-20250514")
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
 
-        with pytest.raises(Exception, match="401 Unauthorized"):
-            generator.generate_response(query="test")
+        async def run_both():
+            return await asyncio.gather(
+                generator.agenerate_response(query="What is MCP?"),
+                generator.agenerate_response(query="What is MCP?"),
+            )
 
-    @patch("ai_generator.anthropic.Anthropic")
-    def test_empty_api_key_creates_client(self, mock_anthropic_cls):
-        """AIGenerator with empty api_key should still construct, but fail on API call"""
-        mock_client = MagicMock()
-        mock_anthropic_cls.return_value = mock_client
-        mock_client.messages.create.side_effect = Exception("Authentication error: API key is empty")
+        assert asyncio.run(run_both()) == ["Shared answer", "Shared answer"]
+        mock_aclient.messages.create.assert_awaited_once()
+        assert generator._ainflight == {}
 
-        generator = AIGenerator(api_key="", model="claude-sonnet-4-20250514")
+    def test_cancelled_leader_does_not_fail_followers(self, async_anthropic_client_mock, make_text_response):
+        """Cancelling the first of two identical requests should not cancel the other"""
+        mock_aclient = async_anthropic_client_mock
 
-        with pytest.raises(Exception, match="Authentication error"):
-            generator.generate_response(query="test")
+        async def create(**kwargs):
+            await asyncio.sleep(0.1)
+            return make_text_response("Shared answer")
+
+        mock_aclient.messages.create = AsyncMock(side_effect=create)
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514")
+
+        async def run():
+            leader = asyncio.ensure_future(generator.agenerate_response(query="What is MCP?"))
+            while not generator._ainflight:
+                await asyncio.sleep(0.001)
+            follower = asyncio.ensure_future(generator.agenerate_response(query="What is MCP?"))
+            # Let the follower find the in-flight request before the leader goes away
+            await asyncio.sleep(0.03)
+            leader.cancel()
+            return await asyncio.gather(leader, follower, return_exceptions=True)
+
+        leader_result, follower_result = asyncio.run(run())
+
+        assert isinstance(leader_result, asyncio.CancelledError)
+        assert follower_result == "Shared answer"
+        mock_aclient.messages.create.assert_awaited_once()
+        assert generator._ainflight == {}
+
+    def test_slow_tool_becomes_timed_out_result(self, async_anthropic_client_mock, make_text_response, make_tool_use_response):
+        """A tool call exceeding tool_timeout_s should yield an error result, not hang"""
+        mock_aclient = async_anthropic_client_mock
+        mock_aclient.messages.create = AsyncMock(side_effect=[
+            make_tool_use_response("search_course_content", {"query": "MCP"}, "tool_slow"),
+            make_text_response("Search is unavailable right now."),
+        ])
+
+        async def slow_tool(name, **kwargs):
+            await asyncio.sleep(1)
+            return "too late"
+
+        mock_tool_manager = MagicMock(spec=ToolManager)
+        mock_tool_manager.aexecute_tool = slow_tool
+
+        tools = [_SEARCH_TOOL]
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514", tool_timeout_s=0.01)
+        result = asyncio.run(generator.agenerate_response(
+            query="Tell me about MCP", tools=tools, tool_manager=mock_tool_manager
+        ))
+
+        assert result == "Search is unavailable right now."
+        messages = mock_aclient.messages.create.call_args_list[1].kwargs["messages"]
+        assert messages[-1]["content"] == [{
+            "type": "tool_result", "tool_use_id": "tool_slow",
+            "content": "Tool timed out", "is_error": True
+        }]
+
+    def test_slow_claude_call_raises_timeout(self, async_anthropic_client_mock, make_text_response):
+        """A Claude call exceeding per_call_timeout_s should raise to the caller"""
+        mock_aclient = async_anthropic_client_mock
+
+        async def create(**kwargs):
+            await asyncio.sleep(1)
+            return make_text_response("too late")
+
+        mock_aclient.messages.create = AsyncMock(side_effect=create)
+
+        generator = AIGenerator(api_key="test-key", model="claude-sonnet-4-20250514", per_call_timeout_s=0.01)
+        with pytest.raises(TimeoutError):
+            asyncio.run(generator.agenerate_response(query="What is MCP?"))
+        assert generator._ainflight == {}
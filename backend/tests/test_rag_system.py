@@ -1,19 +1,19 @@
+import asyncio
+import copy
 import pytest
-import os
-from unittest.mock import MagicMock, patch, PropertyMock
+from unittest.mock import AsyncMock, MagicMock, patch, PropertyMock
 
 
 class TestRAGSystemQuery:
     """Tests for RAGSystem.query() orchestration"""
 
-    def _create_rag_system_with_mocks(self):
+    def _create_rag_system_with_mocks(self, base_config):
         """Create a RAGSystem with all external dependencies mocked"""
         with patch("rag_system.VectorStore"), \
              patch("rag_system.AIGenerator") as mock_ai_cls, \
              patch("rag_system.DocumentProcessor"):
 
-            from config import Config
-            config = Config()
+            config = copy.copy(base_config)
             config.ANTHROPIC_API_KEY = "test-key"
             config.CHROMA_PATH = "/tmp/test_chroma"
 
@@ -26,44 +26,43 @@ class TestRAGSystemQuery:
 
             return rag, mock_ai
 
-    def test_query_returns_tuple(self):
+    def test_query_returns_tuple(self, base_config):
         """query() should return a (str, list) tuple"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
 
-        result = rag.query("What is MCP?")
+        response, sources = rag.query("What is MCP?")
 
-        assert isinstance(result, tuple)
-        assert len(result) == 2
-        assert isinstance(result[0], str)
-        assert isinstance(result[1], list)
+        assert type(response) is str and type(sources) is list
 
-    def test_query_wraps_prompt(self):
+    def test_query_wraps_prompt(self, base_config):
         """User query should be wrapped in the prompt template"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
 
         rag.query("What is MCP?")
 
         call_kwargs = mock_ai.generate_response.call_args
-        query_arg = call_kwargs.kwargs.get("query") or call_kwargs[1].get("query") or call_kwargs[0][0]
+        query_arg = call_kwargs.kwargs["query"]
         assert "Answer this question about course materials: What is MCP?" in query_arg
+        # The semantic cache matches on the bare question, not the template
+        assert call_kwargs.kwargs["semantic_query"] == "What is MCP?"
 
-    def test_query_passes_tools_and_manager(self):
+    def test_query_passes_tools_and_manager(self, base_config):
         """Tools and tool_manager should be passed to generate_response"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
 
         rag.query("test query")
 
         call_kwargs = mock_ai.generate_response.call_args
-        kwargs = call_kwargs.kwargs if call_kwargs.kwargs else call_kwargs[1]
+        kwargs = call_kwargs.kwargs
         assert "tools" in kwargs
         assert isinstance(kwargs["tools"], list)
         assert len(kwargs["tools"]) > 0  # Should have at least search tool
         assert "tool_manager" in kwargs
         assert kwargs["tool_manager"] is rag.tool_manager
 
-    def test_query_passes_history(self):
+    def test_query_passes_history(self, base_config):
         """Pre-existing session history should be forwarded to generate_response"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
 
         # Create a session and add history
         session_id = rag.session_manager.create_session()
@@ -72,15 +71,15 @@ class TestRAGSystemQuery:
         rag.query("follow up question", session_id)
 
         call_kwargs = mock_ai.generate_response.call_args
-        kwargs = call_kwargs.kwargs if call_kwargs.kwargs else call_kwargs[1]
+        kwargs = call_kwargs.kwargs
         history = kwargs.get("conversation_history")
         assert history is not None
         assert "previous question" in history
         assert "previous answer" in history
 
-    def test_query_resets_sources(self):
+    def test_query_resets_sources(self, base_config):
         """reset_sources() should be called after get_last_sources()"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
 
         # Spy on tool_manager methods
         rag.tool_manager.get_last_sources = MagicMock(return_value=[{"label": "Test", "url": None}])
@@ -91,9 +90,9 @@ class TestRAGSystemQuery:
         rag.tool_manager.get_last_sources.assert_called_once()
         rag.tool_manager.reset_sources.assert_called_once()
 
-    def test_query_updates_session(self):
+    def test_query_updates_session(self, base_config):
         """Session history should be updated with query and response after call"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
 
         session_id = rag.session_manager.create_session()
         rag.query("test question", session_id)
@@ -102,9 +101,48 @@ class TestRAGSystemQuery:
         assert "test question" in history
         assert "Test response about MCP" in history
 
-    def test_exception_propagates_to_caller(self):
+    def test_aquery_uses_async_generator_with_own_tool_manager(self, base_config):
+        """aquery() should await agenerate_response with a per-request ToolManager"""
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
+        mock_ai.agenerate_response = AsyncMock(return_value="Async response")
+
+        session_id = rag.session_manager.create_session()
+        response, sources = asyncio.run(rag.aquery("What is MCP?", session_id))
+
+        assert response == "Async response"
+        assert sources == []
+        kwargs = mock_ai.agenerate_response.call_args.kwargs
+        assert kwargs["tool_manager"] is not rag.tool_manager
+        assert len(kwargs["tools"]) == len(rag.tool_manager.get_tool_definitions())
+        assert "Async response" in rag.session_manager.get_conversation_history(session_id)
+
+    def test_stream_query_yields_text_then_sources(self, base_config):
+        """stream_query() should yield text events, a final sources event, and record history"""
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
+        mock_ai.stream_response.return_value = iter(["Streamed ", "answer"])
+
+        session_id = rag.session_manager.create_session()
+        events = list(rag.stream_query("What is MCP?", session_id))
+
+        assert events == [{"text": "Streamed "}, {"text": "answer"}, {"sources": []}]
+        assert "Streamed answer" in rag.session_manager.get_conversation_history(session_id)
+
+    def test_stream_query_discards_tool_preamble(self, base_config):
+        """A discard marker should become a discard event and drop the preamble from history"""
+        from ai_generator import STREAM_DISCARD
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
+        mock_ai.stream_response.return_value = iter(["Let me search.", STREAM_DISCARD, "Answer."])
+
+        session_id = rag.session_manager.create_session()
+        events = list(rag.stream_query("What is MCP?", session_id))
+
+        assert events == [{"text": "Let me search."}, {"discard": True}, {"text": "Answer."}, {"sources": []}]
+        history = rag.session_manager.get_conversation_history(session_id)
+        assert "Answer." in history and "Let me search." not in history
+
+    def test_exception_propagates_to_caller(self, base_config):
         """Exceptions in generate_response should propagate (triggers HTTP 500)"""
-        rag, mock_ai = self._create_rag_system_with_mocks()
+        rag, mock_ai = self._create_rag_system_with_mocks(base_config)
         mock_ai.generate_response.side_effect = Exception("API key invalid")
 
         with pytest.raises(Exception, match="API key invalid"):
@@ -127,68 +165,35 @@ class TestRAGSystemIntegration:
             f"Model '{config.ANTHROPIC_MODEL}' doesn't look like a valid Claude model"
         )
 
-    def test_vector_store_has_data(self):
+    def test_vector_store_has_data(self, chroma_store):
         """DIAGNOSTIC: ChromaDB should have courses loaded from docs/"""
-        chroma_path = os.path.join(os.path.dirname(__file__), "..", "chroma_db")
-        if not os.path.exists(chroma_path):
-            pytest.skip("chroma_db directory not found - server may not have been started yet")
-
-        from vector_store import VectorStore
-        store = VectorStore(
-            chroma_path=chroma_path,
-            embedding_model="all-MiniLM-L6-v2",
-            max_results=5
-        )
-
-        count = store.get_course_count()
-        titles = store.get_existing_course_titles()
+        count = chroma_store.get_course_count()
+        titles = chroma_store.get_existing_course_titles()
 
         assert count > 0, "ChromaDB has 0 courses - documents were never loaded"
         assert len(titles) > 0, "No course titles found in ChromaDB"
 
-    def test_vector_store_search_works(self):
+    def test_vector_store_search_works(self, chroma_store):
         """DIAGNOSTIC: Semantic search should return results for a generic query"""
-        chroma_path = os.path.join(os.path.dirname(__file__), "..", "chroma_db")
-        if not os.path.exists(chroma_path):
-            pytest.skip("chroma_db directory not found")
-
-        from vector_store import VectorStore
-        store = VectorStore(
-            chroma_path=chroma_path,
-            embedding_model="all-MiniLM-L6-v2",
-            max_results=5
-        )
-
         # Skip if no data loaded
-        if store.get_course_count() == 0:
+        if chroma_store.get_course_count() == 0:
             pytest.skip("No courses in ChromaDB")
 
-        results = store.search(query="introduction")
+        results = chroma_store.search(query="introduction")
 
         assert results.error is None, f"Search returned error: {results.error}"
         assert not results.is_empty(), "Search for 'introduction' returned no results"
         assert len(results.documents) > 0
         assert len(results.metadata) > 0
 
-    def test_search_tool_end_to_end(self):
+    def test_search_tool_end_to_end(self, chroma_store):
         """DIAGNOSTIC: CourseSearchTool should produce formatted output with real data"""
-        chroma_path = os.path.join(os.path.dirname(__file__), "..", "chroma_db")
-        if not os.path.exists(chroma_path):
-            pytest.skip("chroma_db directory not found")
-
-        from vector_store import VectorStore
         from search_tools import CourseSearchTool
 
-        store = VectorStore(
-            chroma_path=chroma_path,
-            embedding_model="all-MiniLM-L6-v2",
-            max_results=5
-        )
-
-        if store.get_course_count() == 0:
+        if chroma_store.get_course_count() == 0:
             pytest.skip("No courses in ChromaDB")
 
-        tool = CourseSearchTool(store)
+        tool = CourseSearchTool(chroma_store)
         result = tool.execute(query="introduction")
 
         # Should not be an error message
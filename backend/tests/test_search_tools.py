@@ -1,89 +1,160 @@
+import copy
+import functools
+import json
+import threading
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock
 from search_tools import CourseSearchTool, CourseOutlineTool, ToolManager
 from vector_store import SearchResults
 
+# mock_vector_store is session-scoped; undo each test's configuration of it
+pytestmark = pytest.mark.usefixtures("reset_vector_store")
 
-class TestCourseSearchToolExecute:
-    """Tests for CourseSearchTool.execute() output behavior"""
+_LESSONS_JSON = json.dumps([
+    {"lesson_number": 0, "lesson_title": "Introduction", "lesson_link": "https://example.com/0"},
+    {"lesson_number": 1, "lesson_title": "Getting Started", "lesson_link": "https://example.com/1"},
+])
 
-    def test_execute_returns_formatted_results(self, mock_vector_store, sample_search_results):
-        """execute() should return formatted string with [Course - Lesson N] headers"""
-        tool = CourseSearchTool(mock_vector_store)
-        result = tool.execute(query="what is MCP")
-
-        # Should contain course title in brackets
-        assert "[Introduction to MCP" in result
-        # Should contain lesson numbers
-        assert "Lesson 1" in result
-        assert "Lesson 2" in result
-        # Should contain the actual document content
-        assert "MCP stands for Model Context Protocol" in result
-        assert "client-server pattern" in result
-        # Should have populated last_sources
-        assert len(tool.last_sources) == 2
-        assert tool.last_sources[0]["label"] == "Introduction to MCP - Lesson 1"
-        assert tool.last_sources[0]["url"] == "https://example.com/lesson/1"
-        # Should have called vector store with correct args
-        mock_vector_store.search.assert_called_once_with(
-            query="what is MCP", course_name=None, lesson_number=None
-        )
+_OUTLINE_METADATA = {
+    "title": "Introduction to MCP",
+    "course_link": "https://example.com/mcp",
+    "instructor": "Test Instructor",
+    "lessons_json": _LESSONS_JSON,
+}
 
-    def test_execute_with_filters(self, mock_vector_store):
-        """course_name and lesson_number should be passed through to store.search()"""
-        tool = CourseSearchTool(mock_vector_store)
-        tool.execute(query="embeddings", course_name="MCP", lesson_number=2)
 
-        mock_vector_store.search.assert_called_once_with(
-            query="embeddings", course_name="MCP", lesson_number=2
-        )
+# Course title in brackets, lesson numbers, and the document content
+_RESULT_NEEDLES = (
+    "[Introduction to MCP", "Lesson 1", "Lesson 2",
+    "MCP stands for Model Context Protocol", "client-server pattern",
+)
+
+# Title, link, instructor, each lesson, and the lesson count
+_OUTLINE_NEEDLES = (
+    "Course: Introduction to MCP", "https://example.com/mcp", "Test Instructor",
+    "Lesson 0: Introduction", "Lesson 1: Getting Started", "2 total",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _fmt(docs, meta, dist):
+    """
+    Memoized CourseSearchTool._format_results over hashable inputs, with each
+    metadata dict passed as a tuple of items. No store is attached, so inputs
+    must not carry lesson numbers, which would trigger a lesson-link lookup.
+    """
+    results = SearchResults(list(docs), [dict(m) for m in meta], list(dist))
+    return CourseSearchTool(None)._format_results(results)
+
+
+@pytest.fixture(scope="module")
+def outline_catalog_mock():
+    """course_catalog mock whose get() returns the outline metadata above"""
+    catalog = MagicMock()
+    catalog.get.return_value = {"metadatas": [_OUTLINE_METADATA]}
+    return catalog
 
-    def test_execute_returns_error_on_search_error(self, mock_vector_store, error_search_results):
-        """When SearchResults has .error set, execute() should return that error string"""
-        mock_vector_store.search.return_value = error_search_results
-        tool = CourseSearchTool(mock_vector_store)
 
-        result = tool.execute(query="anything", course_name="NonExistent")
+@pytest.fixture(scope="module")
+def registered_manager(mock_vector_store):
+    """ToolManager with both course tools registered, shared by the module; reset its sources after use"""
+    manager = ToolManager()
+    manager.register_tool(CourseSearchTool(mock_vector_store))
+    manager.register_tool(CourseOutlineTool(mock_vector_store))
+    return manager
 
-        assert result == "No course found matching 'NonExistent'"
 
-    def test_execute_returns_no_content_on_empty(self, mock_vector_store, empty_search_results):
-        """Empty results (no error) should return 'No relevant content found'"""
-        mock_vector_store.search.return_value = empty_search_results
+class TestCourseSearchToolExecute:
+    """Tests for CourseSearchTool.execute() output behavior"""
+
+    @pytest.mark.parametrize(
+        "results_fixture, kwargs, expected, expected_call",
+        [
+            pytest.param(
+                "sample_search_results",
+                {"query": "what is MCP"},
+                _RESULT_NEEDLES,
+                ("what is MCP", None, None),
+                id="formatted_results",
+            ),
+            pytest.param(
+                "sample_search_results",
+                {"query": "embeddings", "course_name": "MCP", "lesson_number": 2},
+                (),
+                # Filters are passed through to store.search()
+                ("embeddings", "MCP", 2),
+                id="filters_passed_through",
+            ),
+            pytest.param(
+                "error_search_results",
+                {"query": "anything", "course_name": "NonExistent"},
+                # SearchResults.error is returned verbatim
+                "No course found matching 'NonExistent'",
+                ("anything", "NonExistent", None),
+                id="search_error",
+            ),
+            pytest.param(
+                "empty_search_results",
+                {"query": "obscure topic"},
+                ("No relevant content found",),
+                ("obscure topic", None, None),
+                id="no_content",
+            ),
+            pytest.param(
+                "empty_search_results",
+                {"query": "obscure", "course_name": "MCP", "lesson_number": 3},
+                # The empty-results message names the filters used
+                ("course 'MCP'", "lesson 3"),
+                ("obscure", "MCP", 3),
+                id="no_content_with_filters",
+            ),
+        ],
+    )
+    def test_execute_output(self, request, mock_vector_store, results_fixture, kwargs,
+                            expected, expected_call):
+        """execute() output for formatted, error, and empty search results"""
+        mock_vector_store.search_return = request.getfixturevalue(results_fixture)
         tool = CourseSearchTool(mock_vector_store)
 
-        result = tool.execute(query="obscure topic")
+        result = tool.execute(**kwargs)
 
-        assert "No relevant content found" in result
+        if isinstance(expected, str):
+            assert result == expected
+        else:
+            for sub in expected:
+                assert sub in result
+        assert mock_vector_store.search_calls == [expected_call]
 
-    def test_execute_no_content_includes_filter_info(self, mock_vector_store, empty_search_results):
-        """Empty results message should include filter context when filters are used"""
-        mock_vector_store.search.return_value = empty_search_results
+    def test_execute_tracks_sources(self, mock_vector_store):
+        """execute() should populate last_sources with labels and lesson links"""
         tool = CourseSearchTool(mock_vector_store)
+        tool.execute(query="what is MCP")
+
+        assert len(tool.last_sources) == 2
+        assert tool.last_sources[0]["label"] == "Introduction to MCP - Lesson 1"
+        assert tool.last_sources[0]["url"] == "https://example.com/lesson/1"
 
-        result = tool.execute(query="obscure", course_name="MCP", lesson_number=3)
+    def test_execute_leaves_shared_results_unmodified(self, mock_vector_store, sample_search_results):
+        """execute() must only read SearchResults, since the fixtures share one instance"""
+        before = copy.deepcopy(sample_search_results)
+        CourseSearchTool(mock_vector_store).execute(query="what is MCP")
 
-        assert "course 'MCP'" in result
-        assert "lesson 3" in result
+        assert sample_search_results == before
 
     def test_execute_propagates_vector_store_exception(self, mock_vector_store):
         """If store.search() raises an exception, it should propagate uncaught.
         This is a key failure mode -- CourseSearchTool.execute() has no try/except."""
-        mock_vector_store.search.side_effect = Exception("ChromaDB connection failed")
+        mock_vector_store.search_exc = Exception("ChromaDB connection failed")
         tool = CourseSearchTool(mock_vector_store)
 
-        with pytest.raises(Exception, match="ChromaDB connection failed"):
+        with pytest.raises(Exception) as excinfo:
             tool.execute(query="anything")
+        assert str(excinfo.value) == "ChromaDB connection failed"
 
-    def test_format_results_handles_missing_metadata(self, mock_vector_store):
+    def test_format_results_handles_missing_metadata(self):
         """Missing metadata keys should not crash formatting"""
-        results = SearchResults(
-            documents=["Some content here"],
-            metadata=[{}],  # No course_title or lesson_number
-            distances=[0.3]
-        )
-        tool = CourseSearchTool(mock_vector_store)
-        formatted = tool._format_results(results)
+        # No course_title or lesson_number
+        formatted = _fmt(("Some content here",), ((),), (0.3,))
 
         # Should use 'unknown' for missing course_title (line 94 uses .get default)
         assert "[unknown]" in formatted
@@ -93,17 +164,19 @@ class TestCourseSearchToolExecute:
 class TestToolManager:
     """Tests for ToolManager registration, dispatch, and source tracking"""
 
-    def test_register_and_execute_tool(self, mock_vector_store):
-        """ToolManager should dispatch execute_tool() to the correct registered tool"""
-        manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-        manager.register_tool(tool)
+    @pytest.fixture(autouse=True)
+    def _reset_registered_sources(self, registered_manager):
+        """Sources are the only state tests leave on the shared manager"""
+        yield
+        registered_manager.reset_sources()
 
-        result = manager.execute_tool("search_course_content", query="test")
+    def test_register_and_execute_tool(self, registered_manager, mock_vector_store):
+        """ToolManager should dispatch execute_tool() to the correct registered tool"""
+        result = registered_manager.execute_tool("search_course_content", query="test")
 
         assert isinstance(result, str)
         assert len(result) > 0
-        mock_vector_store.search.assert_called_once()
+        assert mock_vector_store.search_calls == [("test", None, None)]
 
     def test_execute_unknown_tool(self):
         """Executing an unregistered tool name should return an error string"""
@@ -112,28 +185,68 @@ class TestToolManager:
 
         assert result == "Tool 'nonexistent_tool' not found"
 
-    def test_tool_definitions_valid_format(self, mock_vector_store):
-        """Tool definitions should have required Anthropic API fields"""
+    def test_execute_tools_batch(self, registered_manager, mock_vector_store):
+        """execute_tools should return one outcome per call, in order, with errors in place"""
+        manager = registered_manager
+        mock_vector_store.resolve_exc = RuntimeError("db down")
+
+        search, outline = manager.execute_tools([
+            ("search_course_content", {"query": "test"}),
+            ("get_course_outline", {"course_name": "MCP"}),
+        ])
+
+        assert search == manager.execute_tool("search_course_content", query="test")
+        assert isinstance(outline, RuntimeError)
+
+    def test_execute_tools_sources_follow_call_order(self):
+        """Concurrent calls to one tool should leave the last call's sources, like a sequential run"""
+        second_done = threading.Event()
+
+        class OrderedStore:
+            def search(self, query, course_name=None, lesson_number=None):
+                # The first call finishes only after the second has returned
+                if query == "first":
+                    second_done.wait(timeout=1)
+                else:
+                    second_done.set()
+                return SearchResults([query], [{"course_title": query}], [0.1])
+
         manager = ToolManager()
-        manager.register_tool(CourseSearchTool(mock_vector_store))
-        manager.register_tool(CourseOutlineTool(mock_vector_store))
+        manager.register_tool(CourseSearchTool(OrderedStore()))
+
+        manager.execute_tools([
+            ("search_course_content", {"query": "first"}),
+            ("search_course_content", {"query": "second"}),
+        ])
 
-        definitions = manager.get_tool_definitions()
+        assert manager.get_last_sources() == [{"label": "second", "url": None}]
+
+    def test_tool_definitions_valid_format(self, registered_manager):
+        """Tool definitions should have required Anthropic API fields"""
+        definitions = registered_manager.get_tool_definitions()
 
         assert len(definitions) == 2
+        required = {"name", "description", "input_schema"}
         for defn in definitions:
-            assert "name" in defn
-            assert "description" in defn
-            assert "input_schema" in defn
-            schema = defn["input_schema"]
-            assert schema["type"] == "object"
-            assert "properties" in schema
-
-    def test_source_tracking_and_reset(self, mock_vector_store):
-        """Sources should be available after search and cleared after reset"""
+            assert required <= defn.keys()
+            assert defn["input_schema"]["type"] == "object" and "properties" in defn["input_schema"]
+
+    def test_tool_definitions_shared_until_register(self, mock_vector_store):
+        """Definitions should be built once and rebuilt after a new registration"""
         manager = ToolManager()
-        tool = CourseSearchTool(mock_vector_store)
-        manager.register_tool(tool)
+        manager.register_tool(CourseSearchTool(mock_vector_store))
+
+        first = manager.get_tool_definitions()
+        assert manager.get_tool_definitions() is first
+
+        manager.register_tool(CourseOutlineTool(mock_vector_store))
+        assert [d["name"] for d in manager.get_tool_definitions()] == [
+            "search_course_content", "get_course_outline"
+        ]
+
+    def test_source_tracking_and_reset(self, registered_manager):
+        """Sources should be available after search and cleared after reset"""
+        manager = registered_manager
 
         # Execute a search to populate sources
         manager.execute_tool("search_course_content", query="test")
@@ -144,40 +257,38 @@ class TestToolManager:
         manager.reset_sources()
         assert manager.get_last_sources() == []
 
+    def test_restore_sources(self, registered_manager):
+        """restore_sources() should make previously captured sources visible again"""
+        manager = registered_manager
+
+        cached = [{"label": "Introduction to MCP - Lesson 1", "url": None}]
+        manager.restore_sources(cached)
+
+        assert manager.get_last_sources() == cached
+
+    def test_is_stateful(self, registered_manager):
+        """Built-in tools are stateless; unknown tool names are treated as stateful"""
+        assert registered_manager.is_stateful("search_course_content") is False
+        assert registered_manager.is_stateful("nonexistent_tool") is True
+
 
 class TestCourseOutlineTool:
     """Tests for CourseOutlineTool.execute()"""
 
-    def test_execute_returns_formatted_outline(self, mock_vector_store):
+    def test_execute_returns_formatted_outline(self, mock_vector_store, outline_catalog_mock):
         """Should return formatted course outline with title, link, instructor, lessons"""
-        import json
-        mock_vector_store._resolve_course_name.return_value = "Introduction to MCP"
-        mock_vector_store.course_catalog = MagicMock()
-        mock_vector_store.course_catalog.get.return_value = {
-            "metadatas": [{
-                "title": "Introduction to MCP",
-                "course_link": "https://example.com/mcp",
-                "instructor": "Test Instructor",
-                "lessons_json": json.dumps([
-                    {"lesson_number": 0, "lesson_title": "Introduction", "lesson_link": "https://example.com/0"},
-                    {"lesson_number": 1, "lesson_title": "Getting Started", "lesson_link": "https://example.com/1"},
-                ])
-            }]
-        }
+        mock_vector_store.resolve_return = "Introduction to MCP"
+        mock_vector_store.course_catalog = outline_catalog_mock
 
         tool = CourseOutlineTool(mock_vector_store)
         result = tool.execute(course_name="MCP")
 
-        assert "Course: Introduction to MCP" in result
-        assert "https://example.com/mcp" in result
-        assert "Test Instructor" in result
-        assert "Lesson 0: Introduction" in result
-        assert "Lesson 1: Getting Started" in result
-        assert "2 total" in result
+        for needle in _OUTLINE_NEEDLES:
+            assert needle in result
 
     def test_execute_returns_not_found(self, mock_vector_store):
         """Should return not-found message when course doesn't exist"""
-        mock_vector_store._resolve_course_name.return_value = None
+        mock_vector_store.resolve_return = None
         tool = CourseOutlineTool(mock_vector_store)
 
         result = tool.execute(course_name="Nonexistent")